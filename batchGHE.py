@@ -0,0 +1,160 @@
+#!/usr/bin/python3
+# Batch runner: apply the same kind of change across several course orgs in one process, e.g. a department-wide
+# permission flip at a deadline. The orgs, assignments and desired perms come from a JSON file:
+#
+#   {
+#     "orgs_at_once": 4,          # orgs worked on concurrently
+#     "workers": 8,               # concurrent requests per org (default GHE_WORKERS)
+#     "rate_budget": 3000,        # rate-limit points the whole batch may use (default: no cap beyond the usual reserve)
+#     "orgs": [
+#       { "org": "CPSC210-2026W-T1",
+#         "create": [ { "assn": "lab3", "team": "students", "template": "CPSC210-2026W-T1/lab3", "userPerms": "push" } ],
+#         "perms": [ { "assns": ["lab1", "lab2"], "userPerms": "pull", "staffPerms": "admin" } ],
+#         "archive": [ "lab0" ] },
+#       { "org": "CPSC221-2026W-T1", "workers": 4, "dryrun": true,
+#         "perms": [ { "assns": { "pa1": "^pa1_\\S+$" }, "userPerms": "pull" } ] }
+#     ]
+#   }
+#
+# For each org, "create" runs first, then "perms" (setAssnPermsBatch), then "archive". GHE_TOKEN, GHE_APIURL,
+# GHE_CACHE, GHE_INVENTORY, GHE_JOURNAL and GHE_DRYRUN are read from the environment as usual.
+# All orgs share one connection pool, journal and inventory, and a consolidated summary is printed at the end.
+#
+#   python3 batchGHE.py deadline.json --log-file deadline.log --json summary.json
+
+import sys
+import json
+import logging
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+from requests.adapters import HTTPAdapter
+
+from manageGHE import manageGHE, gheSession, gheMetrics
+
+
+def runOrg(spec, config, adapter, rateReserve, shared):
+    """ Run every operation listed for one org. Returns its summary. """
+
+    org = spec['org']
+    m = manageGHE(logger=logging.getLogger(f"manageGHE.{org}"), org=org, journal=shared.journal, inventory=shared.inventory)
+    m.workers = int(spec.get('workers', config.get('workers', m.workers)))
+    m.adapter = adapter
+    m.rateReserve = rateReserve
+    if spec.get('dryrun', config.get('dryrun')):
+        m.doUpdates = False
+
+    summary = { 'org': org, 'dryrun': not m.doUpdates, 'operations': [], 'requests': 0, 'rate_limit_points': 0, 'ok': True }
+
+    def run(fn, *args, **kwargs):
+        """ Call a manageGHE operation, adding the HTTP use of its session to the org's totals. """
+        m.metrics = None
+        result = fn(*args, **kwargs)
+        if m.metrics:
+            metrics = m.metrics.toJSON()
+            summary['requests'] += metrics['requests']
+            summary['rate_limit_points'] += metrics['rate_limit_points']
+        return result
+
+    def record(operation, result, **counts):
+        ok = result is not None and not counts.get('failed')
+        summary['ok'] = summary['ok'] and ok
+        summary['operations'].append({ 'operation': operation, 'ok': ok, **counts })
+
+    for create in spec.get('create', []):
+        assn = create['assn']
+        users = run(m.getTeamMembership, create.get('team', 'students'))
+        results = None
+        if users is not None:
+            results = run(m.createAssnReposBatch, [assn], users, templates={ assn: create['template'] } if create.get('template') else None,
+                          userPerms=create.get('userPerms', 'pull'))
+        created = results[assn] if results else {}
+        record(f"create {assn}", results, repos=len(created), failed=sum(not ok for ok in created.values()))
+
+    for perms in spec.get('perms', []):
+        plan = run(m.setAssnPermsBatch, perms['assns'], userPerms=perms.get('userPerms'), staffPerms=perms.get('staffPerms'),
+                   adminPerms=perms.get('adminPerms'), planFile=perms.get('planFile'))
+        record(f"perms {'+'.join(perms['assns'])}", plan, changes=len(plan['changes']) if plan else 0,
+               failed=len(plan.get('failed', [])) if plan else 0)
+
+    for assn in spec.get('archive', []):
+        results = run(m.archiveAssnRepos, assn)
+        record(f"archive {assn}", results, repos=len(results or {}), failed=sum(not ok for ok in (results or {}).values()))
+
+    return summary
+
+
+def rateReserveFor(budget, m, adapter):
+    """ The rate-limit reserve that leaves the batch {budget} points of the token's remaining quota. """
+
+    # https://docs.github.com/en/enterprise-server@2.21/rest/reference/rate-limit
+    # Rate-limit headers come back even where rate limiting is disabled and /rate_limit is a 404.
+    with gheSession(adapter=adapter, logger=m.logger, metrics=gheMetrics(apiURL=m.apiURL)) as s:
+        s.headers.update(m.github_headers)
+        r = s.get(f"{m.apiURL}/rate_limit", cache=False)
+    if 'X-RateLimit-Remaining' not in r.headers:
+        m.logger.warning("No rate limit reported by %s; rate_budget ignored", m.apiURL)
+        return None
+    remaining = int(r.headers['X-RateLimit-Remaining'])
+    m.logger.info("Rate limit: %s points remaining, batch budget %s", remaining, budget)
+    return max(gheSession.rateReserve, remaining - budget)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run manageGHE operations across several orgs from a JSON file.")
+    parser.add_argument('config', help="JSON file describing the orgs, assignments and perms")
+    parser.add_argument('--dryrun', action='store_true', help="plan only, for every org (same as GHE_DRYRUN)")
+    parser.add_argument('--log-file', help="also log to this file")
+    parser.add_argument('--json', help="also write the summary to this file")
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+
+    with open(args.config) as f:
+        config = json.load(f)
+    if args.dryrun:
+        config['dryrun'] = True
+
+    # One handler for every org's logger, with the org in each line.
+    logger = logging.getLogger('manageGHE')
+    logger.setLevel(logging.DEBUG)
+    formatter = logging.Formatter('[%(asctime)s] %(name)s %(levelname)s %(message)s', datefmt='%d/%b/%Y %H:%M:%S')
+    handlers = [ logging.StreamHandler(sys.stdout) ] + ([ logging.FileHandler(args.log_file) ] if args.log_file else [])
+    for handler in handlers:
+        handler.setLevel(logging.DEBUG if args.verbose else logging.INFO)
+        handler.setFormatter(formatter)
+        logger.addHandler(handler)
+
+    orgs = config['orgs']
+    orgsAtOnce = int(config.get('orgs_at_once', 4))
+    # Journal and inventory are opened once (from GHE_JOURNAL / GHE_INVENTORY) and shared by every org.
+    shared = manageGHE(logger=logging.getLogger('manageGHE.batch'))
+    maxWorkers = max([ int(spec.get('workers', config.get('workers', shared.workers))) for spec in orgs ] or [1])
+    poolSize = maxWorkers * min(orgsAtOnce, len(orgs) or 1)
+    adapter = HTTPAdapter(pool_connections=poolSize, pool_maxsize=poolSize)
+    rateReserve = rateReserveFor(int(config['rate_budget']), shared, adapter) if config.get('rate_budget') else None
+
+    with ThreadPoolExecutor(max_workers=orgsAtOnce) as pool:
+        futures = [ pool.submit(runOrg, spec, config, adapter, rateReserve, shared) for spec in orgs ]
+        summaries = []
+        for spec, future in zip(orgs, futures):
+            try:
+                summaries.append(future.result())
+            except Exception:
+                logger.exception("%s failed", spec['org'])
+                summaries.append({ 'org': spec['org'], 'ok': False, 'operations': [], 'requests': 0, 'rate_limit_points': 0 })
+    adapter.close()
+
+    print()
+    print(f"{'org':<24} {'operation':<28} {'ok':<4} {'details'}")
+    for summary in summaries:
+        for operation in summary['operations'] or [ { 'operation': '-', 'ok': summary['ok'] } ]:
+            details = ', '.join(f"{k} {v}" for k, v in operation.items() if k not in ('operation', 'ok'))
+            print(f"{summary['org']:<24} {operation['operation']:<28} {'yes' if operation['ok'] else 'NO':<4} {details}")
+    print(f"{len(summaries)} orgs, {sum(not summary['ok'] for summary in summaries)} with failures, "
+          f"{sum(summary['requests'] for summary in summaries)} requests, "
+          f"{sum(summary['rate_limit_points'] for summary in summaries)} rate-limit points")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(summaries, f, indent=1)
+    sys.exit(0 if all(summary['ok'] for summary in summaries) else 1)
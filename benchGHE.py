@@ -0,0 +1,103 @@
+#!/usr/bin/python3
+# Scale benchmark for manageGHE, run against the local mockGHE stand-in server.
+# For each org size, times createAssnRepos, setAssnPerms and deleteAssnRepos and reports the wall time,
+# the number of requests the server saw and the rate-limit points used, so changes can be compared.
+#
+#   python3 benchGHE.py --sizes 1000 5000 20000 --latency 0.02 --json bench.json
+
+import os, sys
+import json
+import time
+import logging
+import argparse
+import tempfile
+import builtins
+
+from mockGHE import mockGHE, mockOrg
+
+
+def bench(name, server, fn):
+    """ Run {fn} and measure it against {server}'s counters. """
+    requests0, quota0 = server.requestCount(), server.quotaUsed
+    start = time.perf_counter()
+    fn()
+    return {
+        'operation': name,
+        'seconds': round(time.perf_counter() - start, 3),
+        'requests': server.requestCount() - requests0,
+        'rate_limit_points': server.quotaUsed - quota0,
+    }
+
+
+def runSize(size, args):
+    org = mockOrg.synthetic('MOCK-ORG', repos=size, assns=args.assns)
+    server = mockGHE(org, latency=args.latency, rateLimit=args.rate_limit, generateDelay=args.generate_delay).start()
+
+    os.environ.update({ 'GHE_APIURL': server.apiURL, 'GHE_ORG': org.name, 'GHE_TOKEN': 'mock', 'GHE_WORKERS': str(args.workers) })
+    os.environ.pop('GHE_DRYRUN', None)
+    for var in ('GHE_JOURNAL', 'GHE_INVENTORY', 'GHE_AUDIT'):
+        os.environ.pop(var, None)
+    cacheDir = tempfile.TemporaryDirectory() if args.cache else None
+    if cacheDir:
+        os.environ['GHE_CACHE'] = cacheDir.name
+        os.environ.pop('GHE_NOCACHE', None)
+    else:
+        os.environ['GHE_NOCACHE'] = '1'
+
+    from manageGHE import manageGHE
+    logger = logging.getLogger('benchGHE')
+    m = manageGHE(logger=logger)
+
+    results = []
+    students = []
+    results.append(bench('getTeamMembership', server, lambda: students.extend(m.getTeamMembership('students'))))
+    results.append(bench('createAssnRepos', server, lambda: m.createAssnRepos('bench', students)))
+    results.append(bench('createAssnRepos (template)', server,
+                         lambda: m.createAssnRepos('benchtmpl', students, template=f"{org.name}/assnTemplate")))
+    results.append(bench('setAssnPerms', server, lambda: m.setAssnPerms('assn1', userPerms='push', staffPerms='admin')))
+    if args.cache:
+        results.append(bench('setAssnPerms (warm cache)', server, lambda: m.setAssnPerms('assn1', userPerms='push', staffPerms='admin')))
+
+    results.append(bench('archiveAssnRepos', server, lambda: m.archiveAssnRepos('assn2')))
+
+    answer = builtins.input
+    builtins.input = lambda prompt='': 'I am sure.'
+    try:
+        results.append(bench('deleteAssnRepos', server, lambda: m.deleteAssnRepos('bench')))
+        m.deleteAssnRepos('benchtmpl')
+    finally:
+        builtins.input = answer
+
+    server.shutdown()
+    server.server_close()
+    if cacheDir:
+        cacheDir.cleanup()
+    for result in results:
+        result['org_repos'] = size
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark manageGHE against synthetic orgs on the mockGHE server.")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 5000, 20000], help="org sizes (number of repos)")
+    parser.add_argument('--assns', type=int, default=5, help="assignments the repos are spread over")
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds added to each request by the server")
+    parser.add_argument('--rate-limit', type=int, default=10**9, help="server rate limit per hour")
+    parser.add_argument('--generate-delay', type=float, default=0.5, help="seconds until a generated repo is ready")
+    parser.add_argument('--workers', type=int, default=8, help="GHE_WORKERS")
+    parser.add_argument('--cache', action='store_true', help="enable the on-disk HTTP cache (and time a warm rerun)")
+    parser.add_argument('--json', help="also write the results to this file")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, format='%(levelname)s %(message)s')
+    allResults = []
+    print(f"{'repos':>7} {'operation':<28} {'seconds':>9} {'requests':>9} {'points':>9}")
+    for size in args.sizes:
+        for result in runSize(size, args):
+            allResults.append(result)
+            print(f"{result['org_repos']:>7} {result['operation']:<28} {result['seconds']:>9.2f} {result['requests']:>9} {result['rate_limit_points']:>9}")
+            sys.stdout.flush()
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(allResults, f, indent=1)
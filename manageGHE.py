@@ -1,9 +1,645 @@
 #!/usr/bin/python3 -i
 
 import os, sys
+import json
 import re
+import time
+import random
+import base64
+import hashlib
 import logging
+import sqlite3
+import threading
 import requests
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from concurrent.futures import ThreadPoolExecutor, Future, as_completed
+
+
+class gheMetrics:
+    """ Per-operation request instrumentation for a gheSession: counts, latency histograms, bytes, retries and
+    status codes per endpoint template, and rate-limit points used per phase (listing, audit, apply, ...).
+    Export with toJSON() / toPrometheus(); with {tracePath} every HTTP call is also appended to a JSON-lines trace.
+    Endpoints are named relative to {apiURL}. """
+
+    buckets = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float('inf'))
+
+    # Path segments followed by names/ids, and the placeholders that replace them.
+    _placeholders = { 'orgs': ('{org}',), 'users': ('{user}',), 'repos': ('{owner}', '{repo}'), 'teams': ('{team}',), 'collaborators': ('{user}',),
+                      'members': ('{user}',), 'branches': ('{branch}',), 'invitations': ('{invitation}',) }
+
+    def __init__(self, tracePath=None, apiURL=None):
+        self.apiPath = urlsplit(apiURL).path.rstrip('/') if apiURL else ''
+        self.phase = 'other'
+        self.started = time.time()
+        self.endpoints = {}
+        self.phases = {}
+        self.rateRemaining = None
+        self._lock = threading.Lock()
+        self._trace = open(tracePath, 'a') if tracePath else None
+
+    @classmethod
+    def template(cls, url, apiPath=''):
+        """ The endpoint template of {url}, e.g. '/repos/{owner}/{repo}/collaborators/{user}', relative to the API root
+        {apiPath} (e.g. /api/v3; GHE serves GraphQL from the level above, /api/graphql). """
+        path = urlsplit(url).path
+        for prefix in (apiPath, os.path.dirname(apiPath)):
+            if prefix not in ('', '/') and path.startswith(prefix + '/'):
+                path = path[len(prefix):]
+                break
+        segments = path.strip('/').split('/')
+        out = []
+        i = 0
+        while i < len(segments):
+            out.append(segments[i])
+            names = cls._placeholders.get(segments[i], ())
+            if len(segments) > i + len(names):
+                out += names
+                i += len(names)
+            i += 1
+        return '/' + '/'.join(out)
+
+    def record(self, method, url, status, seconds, sent, received, retry=False, rateRemaining=None, phase=None):
+        """ Record one HTTP call, under {phase} if given (e.g. a listing running alongside an audit), else the current phase.
+        A 304 (or a failed connection, status None) doesn't use rate-limit quota. """
+        key = f"{method.upper()} {self.template(url, self.apiPath)}"
+        phase = phase or self.phase
+        points = 0 if status in (304, None) else 1
+        with self._lock:
+            e = self.endpoints.get(key)
+            if e is None:
+                e = self.endpoints[key] = { 'requests': 0, 'seconds': 0.0, 'sent_bytes': 0, 'received_bytes': 0, 'retries': 0,
+                                            'status': {}, 'latency_buckets': [0] * len(self.buckets) }
+            e['requests'] += 1
+            e['seconds'] += seconds
+            e['sent_bytes'] += sent
+            e['received_bytes'] += received
+            e['retries'] += retry
+            e['status'][str(status)] = e['status'].get(str(status), 0) + 1
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    e['latency_buckets'][i] += 1
+            p = self.phases.setdefault(phase, { 'requests': 0, 'rate_limit_points': 0, 'seconds': 0.0 })
+            p['requests'] += 1
+            p['rate_limit_points'] += points
+            p['seconds'] += seconds
+            if rateRemaining is not None:
+                self.rateRemaining = rateRemaining
+            if self._trace:
+                self._trace.write(json.dumps({ 'time': time.time(), 'phase': phase, 'method': method.upper(), 'url': url,
+                                               'endpoint': key, 'status': status, 'seconds': round(seconds, 4),
+                                               'sent': sent, 'received': received, 'retry': retry }) + "\n")
+
+    def toJSON(self):
+        with self._lock:
+            return {
+                'wall_seconds': round(time.time() - self.started, 3),
+                'requests': sum(e['requests'] for e in self.endpoints.values()),
+                'rate_limit_points': sum(p['rate_limit_points'] for p in self.phases.values()),
+                'rate_limit_remaining': self.rateRemaining,
+                'latency_buckets': [ str(bound) for bound in self.buckets ],
+                'phases': json.loads(json.dumps(self.phases)),
+                'endpoints': json.loads(json.dumps(self.endpoints)),
+            }
+
+    def toPrometheus(self):
+        """ The metrics in Prometheus text exposition format. """
+        lines = []
+
+        def metric(name, kind, help, samples):
+            lines.append(f"# HELP ghe_{name} {help}")
+            lines.append(f"# TYPE ghe_{name} {kind}")
+            for labels, value in samples:
+                label = ','.join(f'{k}="{v}"' for k, v in labels.items())
+                lines.append(f"ghe_{name}{{{label}}} {value}")
+
+        with self._lock:
+            ep = [ (dict(zip(('method', 'endpoint'), key.split(' ', 1))), e) for key, e in sorted(self.endpoints.items()) ]
+            metric('requests_total', 'counter', "HTTP requests by endpoint and status.",
+                   [ ({ **l, 'status': status }, n) for l, e in ep for status, n in sorted(e['status'].items()) ])
+            metric('retries_total', 'counter', "Retried HTTP requests.", [ (l, e['retries']) for l, e in ep ])
+            metric('sent_bytes_total', 'counter', "Request body bytes sent.", [ (l, e['sent_bytes']) for l, e in ep ])
+            metric('received_bytes_total', 'counter', "Response body bytes received.", [ (l, e['received_bytes']) for l, e in ep ])
+            lines.append("# HELP ghe_request_seconds HTTP request latency.")
+            lines.append("# TYPE ghe_request_seconds histogram")
+            for l, e in ep:
+                label = ','.join(f'{k}="{v}"' for k, v in l.items())
+                for bound, n in zip(self.buckets, e['latency_buckets']):
+                    le = '+Inf' if bound == float('inf') else bound
+                    lines.append(f'ghe_request_seconds_bucket{{{label},le="{le}"}} {n}')
+                lines.append(f"ghe_request_seconds_sum{{{label}}} {e['seconds']:.6f}")
+                lines.append(f"ghe_request_seconds_count{{{label}}} {e['requests']}")
+            metric('rate_limit_points_total', 'counter', "Rate-limit points used by phase.",
+                   [ ({ 'phase': phase }, p['rate_limit_points']) for phase, p in sorted(self.phases.items()) ])
+            if self.rateRemaining is not None:
+                metric('rate_limit_remaining', 'gauge', "Last reported X-RateLimit-Remaining.", [ ({}, self.rateRemaining) ])
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        j = self.toJSON()
+        phases = ', '.join(f"{phase} {p['requests']}/{p['rate_limit_points']}" for phase, p in j['phases'].items())
+        return f"{j['requests']} requests, {j['rate_limit_points']} rate-limit points in {j['wall_seconds']}s (requests/points: {phases})"
+
+    def close(self, exportPrefix=None):
+        """ Finish the operation: close the trace and, given {exportPrefix}, write {exportPrefix}.json and .prom. """
+        if self._trace:
+            self._trace.close()
+            self._trace = None
+        if exportPrefix:
+            with open(f"{exportPrefix}.json", 'w') as f:
+                json.dump(self.toJSON(), f, indent=1)
+            with open(f"{exportPrefix}.prom", 'w') as f:
+                f.write(self.toPrometheus())
+
+
+class gheSession(requests.Session):
+    """ requests.Session with an optional on-disk cache for conditional GETs.
+    Responses carrying an ETag or Last-Modified header are stored in {cacheDir}, keyed by url, query and
+    the Accept/Authorization headers. Later GETs of the same url send If-None-Match/If-Modified-Since, and a
+    304 (which GitHub doesn't count against the rate limit) is answered from the local copy.
+    Pass cache=False to a single request to bypass the cache.
+
+    Every request is also scheduled: at most {concurrency} are in flight at once, requests wait when the
+    X-RateLimit-Remaining quota runs down to {rateReserve} until X-RateLimit-Reset, and transient failures
+    (5xx, secondary/abuse rate limit 403s, 429s) are retried with backoff. {concurrency} is adapted between 1 and
+    {maxConcurrency}: halved whenever a request is throttled, and raised by one after a run of clean responses.
+
+    An {adapter} (connection pool) passed in is shared with other sessions, e.g. one per org in batchGHE.py,
+    and is left open when this session closes. """
+
+    maxRetries = 5
+    backoff = 1.0
+    rateReserve = 20
+    # Cache directories already evicted by this process; every session of an operation (or of several orgs, in
+    # batchGHE.py) shares the cache, so it is only swept once.
+    _evicted = set()
+    _evictLock = threading.Lock()
+
+    def __init__(self, cacheDir=None, cacheMaxAge=7*24*3600, cacheMaxBytes=200*1024*1024, maxConcurrency=8, logger=None,
+                 metrics=None, metricsPrefix=None, adapter=None):
+        super().__init__()
+        self.sharedAdapter = adapter
+        if adapter:
+            self.mount('https://', adapter)
+            self.mount('http://', adapter)
+        self.logger = logger or logging.getLogger('manageGHE')
+        self.metrics = metrics or gheMetrics()
+        self.metricsPrefix = metricsPrefix
+        self.cacheDir = cacheDir
+        self.cacheMaxAge = cacheMaxAge
+        self.cacheMaxBytes = cacheMaxBytes
+        if self.cacheDir:
+            os.makedirs(self.cacheDir, exist_ok=True)
+            with self._evictLock:
+                evict = os.path.abspath(self.cacheDir) not in self._evicted
+                self._evicted.add(os.path.abspath(self.cacheDir))
+            if evict:
+                self.evictCache()
+
+        self.maxConcurrency = maxConcurrency
+        self.concurrency = maxConcurrency
+        self.rateRemaining = None
+        self.rateReset = None
+        self._inFlight = 0
+        self._clean = 0
+        self._pausedUntil = 0
+        self._slots = threading.Condition()
+
+    def request(self, method, url, cache=True, idempotent=None, phase=None, **kwargs):
+        if not (cache and self.cacheDir and method.upper() == 'GET'):
+            return self._send(method, url, idempotent=idempotent, phase=phase, **kwargs)
+
+        headers = dict(kwargs.pop('headers', None) or {})
+        merged = { **self.headers, **headers }
+        key = hashlib.sha256(json.dumps([url, kwargs.get('params'), merged.get('Accept'), merged.get('Authorization')],
+                                        sort_keys=True, default=str).encode()).hexdigest()
+        path = os.path.join(self.cacheDir, key)
+        entry = None
+        try:
+            with open(path) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            pass
+        if entry:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+
+        r = self._send(method, url, headers=headers, phase=phase, **kwargs)
+        if r.status_code == 304 and entry:
+            os.utime(path)
+            return self._cachedResponse(entry, r)
+        if r.status_code == 200 and ('ETag' in r.headers or 'Last-Modified' in r.headers):
+            entry = {
+                'url': url,
+                'etag': r.headers.get('ETag'),
+                'last_modified': r.headers.get('Last-Modified'),
+                'headers': dict(r.headers),
+                'content': base64.b64encode(r.content).decode('ascii'),
+            }
+            # Write to a temporary file and rename, so concurrent readers never see a partial entry.
+            tmp = f"{path}.{os.getpid()}.{threading.get_ident()}"
+            with open(tmp, 'w') as f:
+                json.dump(entry, f)
+            os.replace(tmp, path)
+        return r
+
+    def _send(self, method, url, idempotent=None, phase=None, **kwargs):
+        """ Send a request once a concurrency slot and rate-limit quota are available, retrying transient failures.
+        Only idempotent methods (or requests the caller marks {idempotent}) are retried after a 5xx or connection
+        error; anything may be retried after being throttled, since the server didn't act on it. """
+
+        if idempotent is None:
+            idempotent = method.upper() in ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+        for attempt in range(self.maxRetries + 1):
+            self._acquire()
+            started = time.perf_counter()
+            try:
+                r = super().request(method, url, **kwargs)
+            except requests.ConnectionError:
+                self.metrics.record(method, url, None, time.perf_counter() - started, 0, 0, retry=attempt > 0, phase=phase)
+                self._release(throttled=False)
+                if not idempotent or attempt == self.maxRetries:
+                    raise
+                delay = self.backoff * 2 ** attempt
+                self.logger.warning("%s %s connection error, retrying in %.1fs", method, url, delay)
+                time.sleep(delay)
+                continue
+
+            sent = len(r.request.body or b'')
+            self.metrics.record(method, url, r.status_code, time.perf_counter() - started, sent, len(r.content), retry=attempt > 0,
+                                rateRemaining=int(r.headers['X-RateLimit-Remaining']) if 'X-RateLimit-Remaining' in r.headers else None,
+                                phase=phase)
+            self._noteRateLimit(r)
+            delay, throttled = self._retryDelay(r, attempt, idempotent)
+            self._release(throttled)
+            if delay is None or attempt == self.maxRetries:
+                return r
+            self.logger.warning("%s %s status_code %s, retrying in %.1fs", method, url, r.status_code, delay)
+            time.sleep(delay)
+
+    def _retryDelay(self, r, attempt, idempotent):
+        """ Returns (seconds to wait before retrying or None, whether the response means we were throttled). """
+
+        # https://docs.github.com/en/enterprise-server@2.21/rest/overview/resources-in-the-rest-api#rate-limiting
+        if r.status_code == 429 or (r.status_code == 403 and ('Retry-After' in r.headers or r.headers.get('X-RateLimit-Remaining') == '0'
+                                                              or 'rate limit' in r.text.lower())):
+            if 'Retry-After' in r.headers:
+                delay = float(r.headers['Retry-After'])
+            elif r.headers.get('X-RateLimit-Remaining') == '0' and 'X-RateLimit-Reset' in r.headers:
+                delay = max(1.0, float(r.headers['X-RateLimit-Reset']) - time.time() + 1)
+            else:
+                # Secondary rate limit with no hint: GitHub recommends waiting at least a minute.
+                delay = max(60.0, self.backoff * 2 ** attempt)
+            with self._slots:
+                self._pausedUntil = max(self._pausedUntil, time.time() + delay)
+            return delay, True
+        if r.status_code in (500, 502, 503, 504) and idempotent:
+            return self.backoff * 2 ** attempt + random.uniform(0, self.backoff), False
+        return None, False
+
+    def _noteRateLimit(self, r):
+        if 'X-RateLimit-Remaining' in r.headers and 'X-RateLimit-Reset' in r.headers:
+            with self._slots:
+                self.rateRemaining = int(r.headers['X-RateLimit-Remaining'])
+                self.rateReset = int(r.headers['X-RateLimit-Reset'])
+
+    def _acquire(self):
+        """ Block until a request may be sent: a free slot, no throttling pause, and quota left above {rateReserve}. """
+        with self._slots:
+            warned = False
+            while True:
+                now = time.time()
+                if self.rateReset is not None and now >= self.rateReset:
+                    # The window has reset; the next response will tell us the new quota.
+                    self.rateRemaining = self.rateReset = None
+                wait = self._pausedUntil - now
+                if self.rateRemaining is not None and self.rateRemaining <= self.rateReserve:
+                    wait = max(wait, self.rateReset - now)
+                if wait > 0:
+                    if not warned:
+                        self.logger.warning("Rate limited: pausing requests for %.0fs", wait)
+                        warned = True
+                    self._slots.wait(wait)
+                elif self._inFlight >= self.concurrency:
+                    self._slots.wait()
+                else:
+                    break
+            self._inFlight += 1
+            if self.rateRemaining is not None:
+                self.rateRemaining -= 1
+
+    def _release(self, throttled):
+        with self._slots:
+            self._inFlight -= 1
+            if throttled:
+                self.concurrency = max(1, self.concurrency // 2)
+                self._clean = 0
+                self.logger.info("Throttled: concurrency reduced to %s", self.concurrency)
+            else:
+                self._clean += 1
+                if self._clean >= self.concurrency * 10 and self.concurrency < self.maxConcurrency:
+                    self.concurrency += 1
+                    self._clean = 0
+            self._slots.notify_all()
+
+    def close(self):
+        if self.sharedAdapter:
+            # Other sessions are still using the pool.
+            self.adapters.clear()
+        super().close()
+        if self.metrics:
+            self.logger.info("HTTP: %s", self.metrics.summary())
+            self.metrics.close(self.metricsPrefix)
+
+    @staticmethod
+    def _cachedResponse(entry, notModified):
+        """ Build a 200 response from a cache {entry}, keeping the fresh headers (e.g. rate limits) of the 304. """
+        r = requests.Response()
+        r.status_code = 200
+        r.reason = 'OK'
+        r.url = entry['url']
+        r.request = notModified.request
+        r.encoding = 'utf-8'
+        r._content = base64.b64decode(entry['content'])
+        r.headers = CaseInsensitiveDict(entry['headers'])
+        r.headers.update({ k : v for k, v in notModified.headers.items() if k.lower().startswith('x-') })
+        r.from_cache = True
+        return r
+
+    def evictCache(self):
+        """ Drop cache entries older than {cacheMaxAge} seconds, then the least recently used until under {cacheMaxBytes}.
+        Other sessions (and processes) may be writing, reading or evicting the same entries meanwhile. """
+        now = time.time()
+        entries = []
+        for entry in os.scandir(self.cacheDir):
+            try:
+                st = entry.stat()
+                if now - st.st_mtime > self.cacheMaxAge:
+                    os.remove(entry.path)
+                elif '.' not in entry.name:
+                    # Temporary files ({key}.{pid}.{thread}) are still being written; only stale ones are removed.
+                    entries.append((st.st_mtime, st.st_size, entry.path))
+            except FileNotFoundError:
+                continue
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.cacheMaxBytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def clearCache(self):
+        """ Remove every cache entry. """
+        for entry in os.scandir(self.cacheDir):
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+
+
+class gheRepo:
+    """ The handful of fields manageGHE uses from a repo listing item, in a slotted record.
+    parsePage() builds these straight from a listing page's JSON, so the rest of each item (owner objects,
+    dozens of urls, ...) is never kept in memory. """
+
+    __slots__ = ('name', 'full_name', 'url', 'updated_at', 'pushed_at', 'archived')
+
+    def __init__(self, name, full_name, url, updated_at=None, pushed_at=None, archived=False):
+        self.name = name
+        self.full_name = full_name
+        self.url = url
+        self.updated_at = updated_at
+        self.pushed_at = pushed_at
+        self.archived = archived
+
+    @classmethod
+    def parsePage(cls, content):
+        """ Parse a page of repos. Nested objects are dropped by the parser as soon as they are read. """
+
+        def pairs(items):
+            fields = dict(items)
+            if 'full_name' not in fields:
+                return None
+            return cls(fields['name'], fields['full_name'], fields['url'], fields.get('updated_at'), fields.get('pushed_at'),
+                       fields.get('archived', False))
+        return json.loads(content, object_pairs_hook=pairs)
+
+    def __repr__(self):
+        return f"gheRepo({self.full_name})"
+
+
+class gheInventory:
+    """ Local SQLite index of an org's repos, their direct collaborators and their team permissions.
+    manageGHE keeps it up to date as it lists and audits repos, and reads the repo listing (and, with
+    GHE_AUDIT=inventory, the permission state) from it instead of the live API. It can also be queried
+    directly, e.g. inventory.lacking(org, 'assn3', 'push') or inventory.query('SELECT ...'). """
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS repos (org TEXT, name TEXT, full_name TEXT, url TEXT, updated_at TEXT, pushed_at TEXT,
+                                          audited_at REAL, archived INTEGER, PRIMARY KEY (org, name));
+        CREATE TABLE IF NOT EXISTS collaborators (org TEXT, full_name TEXT, login TEXT, permission TEXT,
+                                                  PRIMARY KEY (org, full_name, login));
+        CREATE TABLE IF NOT EXISTS teams (org TEXT, full_name TEXT, slug TEXT, permission TEXT, repositories_url TEXT,
+                                          PRIMARY KEY (org, full_name, slug));
+        CREATE TABLE IF NOT EXISTS meta (org TEXT, key TEXT, value TEXT, PRIMARY KEY (org, key));
+    """
+
+    # Permissions in increasing order, for "at least" comparisons.
+    permRank = ('pull', 'triage', 'push', 'maintain', 'admin')
+
+    def __init__(self, path):
+        self.path = path
+        # Worker threads only read; all access is serialized through one connection.
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        self._lock = threading.Lock()
+        with self._lock, self._db:
+            self._db.executescript(self.schema)
+            if 'archived' not in [ row['name'] for row in self._db.execute("PRAGMA table_info(repos)") ]:
+                # An index from before archived was kept: add it, and make the next refresh a full one to fill it in.
+                self._db.execute("ALTER TABLE repos ADD COLUMN archived INTEGER")
+                self._db.execute("DELETE FROM meta WHERE key = 'full_refresh'")
+
+    def query(self, sql, params=()):
+        """ Run an ad-hoc query and return the rows as dicts. """
+        with self._lock:
+            return [ dict(row) for row in self._db.execute(sql, params) ]
+
+    def getMeta(self, org, key):
+        rows = self.query("SELECT value FROM meta WHERE org = ? AND key = ?", (org, key))
+        return rows[0]['value'] if rows else None
+
+    def setMeta(self, org, key, value):
+        with self._lock, self._db:
+            self._db.execute("INSERT OR REPLACE INTO meta VALUES (?, ?, ?)", (org, key, value))
+
+    def latest(self, org):
+        """ The most recent updated_at of any known repo in {org}, or None if the org hasn't been indexed. """
+        return self.query("SELECT max(updated_at) AS latest FROM repos WHERE org = ?", (org,))[0]['latest']
+
+    def saveRepos(self, org, items, full=False):
+        """ Upsert repo listing {items}. A {full} listing also drops repos that no longer exist. """
+        rows = [ (org, item.name, item.full_name, item.url, item.updated_at, item.pushed_at, item.archived) for item in items ]
+        with self._lock, self._db:
+            if full:
+                self._db.execute("CREATE TEMP TABLE IF NOT EXISTS listed (name TEXT PRIMARY KEY)")
+                self._db.execute("DELETE FROM listed")
+                self._db.executemany("INSERT OR IGNORE INTO listed VALUES (?)", [ (row[1],) for row in rows ])
+                for table in ('collaborators', 'teams'):
+                    self._db.execute(f"DELETE FROM {table} WHERE org = ? AND full_name IN "
+                                     "(SELECT full_name FROM repos WHERE org = ? AND name NOT IN (SELECT name FROM listed))", (org, org))
+                self._db.execute("DELETE FROM repos WHERE org = ? AND name NOT IN (SELECT name FROM listed)", (org,))
+            # Keep audited_at of repos we already know about.
+            self._db.executemany("""INSERT INTO repos (org, name, full_name, url, updated_at, pushed_at, archived) VALUES (?, ?, ?, ?, ?, ?, ?)
+                                    ON CONFLICT (org, name) DO UPDATE SET full_name = excluded.full_name, url = excluded.url,
+                                    updated_at = excluded.updated_at, pushed_at = excluded.pushed_at, archived = excluded.archived""", rows)
+
+    def setArchived(self, org, names, archived=True):
+        """ Record that repos {names} were (un)archived. """
+        with self._lock, self._db:
+            self._db.executemany("UPDATE repos SET archived = ? WHERE org = ? AND name = ?", [ (archived, org, name) for name in names ])
+
+    def removeRepos(self, org, names):
+        """ Forget repos {names} (e.g. after deleting them). """
+        with self._lock, self._db:
+            for name in names:
+                row = self._db.execute("SELECT full_name FROM repos WHERE org = ? AND name = ?", (org, name)).fetchone()
+                if row:
+                    for table in ('collaborators', 'teams'):
+                        self._db.execute(f"DELETE FROM {table} WHERE org = ? AND full_name = ?", (org, row['full_name']))
+                self._db.execute("DELETE FROM repos WHERE org = ? AND name = ?", (org, name))
+
+    def repos(self, org):
+        """ All known repos of {org}, as gheRepo records. """
+        with self._lock:
+            return [ gheRepo(row['name'], row['full_name'], row['url'], row['updated_at'], row['pushed_at'], bool(row['archived']))
+                     for row in self._db.execute("SELECT * FROM repos WHERE org = ? ORDER BY name", (org,)) ]
+
+    def saveStates(self, org, states, collaborators=True, teams=True):
+        """ Store audited permission {states} (as returned by manageGHE._auditRepos). Collaborators and teams are
+        only replaced when they were part of the audit. """
+        now = time.time()
+        with self._lock, self._db:
+            for full_name, state in states.items():
+                if collaborators:
+                    self._db.execute("DELETE FROM collaborators WHERE org = ? AND full_name = ?", (org, full_name))
+                    self._db.executemany("INSERT INTO collaborators VALUES (?, ?, ?, ?)",
+                                         [ (org, full_name, login, perm) for login, perm in state['collaborators'].items() ])
+                if teams:
+                    self._db.execute("DELETE FROM teams WHERE org = ? AND full_name = ?", (org, full_name))
+                    self._db.executemany("INSERT INTO teams VALUES (?, ?, ?, ?, ?)",
+                                         [ (org, full_name, slug, perm, url) for slug, (perm, url) in state['teams'].items() ])
+                self._db.execute("UPDATE repos SET audited_at = ? WHERE org = ? AND full_name = ?", (now, org, full_name))
+
+    def saveChanges(self, org, changes):
+        """ Record permission {changes} (as planned by manageGHE) that were applied successfully, so the stored state
+        stays current without re-auditing. """
+        with self._lock, self._db:
+            for change in changes:
+                if change.get('invitation'):
+                    # Not a collaborator until the invitation is accepted.
+                    continue
+                if change['kind'] in ('user', 'drop', 'revoke'):
+                    self._db.execute("DELETE FROM collaborators WHERE org = ? AND full_name = ? AND login = ?",
+                                     (org, change['repo'], change['target']))
+                    if change['permission']:
+                        self._db.execute("INSERT INTO collaborators VALUES (?, ?, ?, ?)",
+                                         (org, change['repo'], change['target'], change['permission']))
+                elif change['kind'] in ('team', 'staff', 'admin'):
+                    # The change's url is the team's repositories_url followed by the repo.
+                    team_repos = change['url'][:-len(change['repo']) - 1]
+                    self._db.execute("INSERT OR REPLACE INTO teams VALUES (?, ?, ?, ?, ?)",
+                                     (org, change['repo'], change['target'], change['permission'], team_repos))
+
+    def states(self, org, fullNames):
+        """ Stored permission states for those of {fullNames} that have been audited. Same shape as manageGHE._auditRepos. """
+        with self._lock:
+            audited = { row['full_name'] for row in self._db.execute(
+                "SELECT full_name FROM repos WHERE org = ? AND audited_at IS NOT NULL", (org,)) }
+            states = { full_name : { 'collaborators': {}, 'teams': {} } for full_name in fullNames if full_name in audited }
+            for row in self._db.execute("SELECT full_name, login, permission FROM collaborators WHERE org = ?", (org,)):
+                if row['full_name'] in states:
+                    states[row['full_name']]['collaborators'][row['login']] = row['permission']
+            for row in self._db.execute("SELECT full_name, slug, permission, repositories_url FROM teams WHERE org = ?", (org,)):
+                if row['full_name'] in states:
+                    states[row['full_name']]['teams'][row['slug']] = (row['permission'], row['repositories_url'])
+        return states
+
+    def lacking(self, org, assn, perm):
+        """ Repos of {assn} whose student (the '{assn}_{login}' suffix) has less than {perm} as a direct collaborator.
+        Only reflects repos that have been audited. Returns rows of repo, login and current permission (None if absent). """
+        weaker = self.permRank[:self.permRank.index(perm)]
+        return self.query(f"""SELECT r.name AS repo, substr(r.name, ?) AS login, c.permission AS permission FROM repos r
+                              LEFT JOIN collaborators c ON c.org = r.org AND c.full_name = r.full_name AND c.login = substr(r.name, ?)
+                              WHERE r.org = ? AND substr(r.name, 1, ?) = ? AND r.audited_at IS NOT NULL
+                              AND (c.permission IS NULL OR c.permission IN ({','.join('?' * len(weaker)) or "''"}))
+                              ORDER BY r.name""",
+                          (len(assn) + 2, len(assn) + 2, org, len(assn) + 1, f"{assn}_", *weaker))
+
+
+class gheJournal:
+    """ Append-only checkpoint journal of completed per-repo steps of bulk operations.
+    Each line is a JSON record { op, key, step, ok, data, time }. When an operation is rerun with the same
+    journal, steps already recorded as ok are skipped, so only failed or pending work is retried.
+    Once an operation finishes cleanly it is marked complete, and the next run of it starts afresh. """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._newline = ''
+        if os.path.exists(path):
+            with open(path) as f:
+                line = ''
+                for line in f:
+                    try:
+                        self._load(json.loads(line))
+                    except ValueError:
+                        # A partial last line from an interrupted run.
+                        continue
+                if line and not line.endswith("\n"):
+                    self._newline = "\n"
+
+    def _load(self, entry):
+        if entry['step'] == 'complete':
+            self._entries = { k : v for k, v in self._entries.items() if k[0] != entry['op'] }
+        else:
+            self._entries[(entry['op'], entry['key'], entry['step'])] = entry
+
+    def done(self, op, key, step):
+        """ The journal entry of a step recorded ok, or None. """
+        with self._lock:
+            entry = self._entries.get((op, key, step))
+        return entry if entry and entry['ok'] else None
+
+    def doneKeys(self, op, step):
+        """ { key : entry } of every step of {op} recorded ok. """
+        # Workers (of several orgs, in batchGHE.py) may be recording meanwhile.
+        with self._lock:
+            return { k[1] : v for k, v in self._entries.items() if k[0] == op and k[2] == step and v['ok'] }
+
+    def entries(self, op, step):
+        """ { key : entry } of every step of {op}, whether it was recorded ok or not. """
+        with self._lock:
+            return { k[1] : v for k, v in self._entries.items() if k[0] == op and k[2] == step }
+
+    def record(self, op, key, step, ok=True, data=None):
+        entry = { 'op': op, 'key': key, 'step': step, 'ok': ok, 'data': data, 'time': time.time() }
+        with self._lock:
+            self._load(entry)
+            with open(self.path, 'a') as f:
+                f.write(self._newline + json.dumps(entry) + "\n")
+            self._newline = ''
+
+    def complete(self, op):
+        """ Mark {op} as finished; its entries no longer apply to later runs. """
+        self.record(op, None, 'complete')
 
 
 class manageGHE:
@@ -13,9 +649,32 @@ class manageGHE:
     org = None
     _token = None
     github_headers = { 'Accept': 'application/vnd.github.v3+json' }
+    graphqlURL = None
     doUpdates = True
+    workers = 8
+    auditBackend = 'rest'
+    cacheDir = os.path.expanduser('~/.cache/manageGHE')
+    inventory = None
+    journal = None
+    metrics = None
+    metricsPrefix = None
+    tracePath = None
+    inventoryMaxAge = 24*3600
+    stageWorkers = None
+    readyInterval = 1
+    readyTimeout = 300
+    watchInterval = 60
+    # Org events and audit log actions that can change who has access to a repo.
+    watchEvents = { 'MemberEvent', 'TeamAddEvent', 'RepositoryEvent' }
+    watchActions = { 'repo.add_member', 'repo.update_member', 'repo.remove_member', 'repo.create', 'repo.transfer',
+                     'team.add_repository', 'team.update_repository_permission', 'team.remove_repository' }
+    graphqlBatch = 100
+    # _auditRepo()'s result for a repo that no longer exists.
+    _gone = object()
+    adapter = None
+    rateReserve = None
 
-    def __init__(self, logger=None, logFile=None, verbose=False):
+    def __init__(self, logger=None, logFile=None, verbose=False, org=None, journal=None, inventory=None):
         if logger:
             self.logger = logger
         else:
@@ -41,11 +700,27 @@ class manageGHE:
             self.logger.addHandler(ch)
 
         self.apiURL = os.getenv('GHE_APIURL', self.apiURL)
-        self.org = os.getenv('GHE_ORG', self.org)
+        # GHE serves GraphQL from /api/graphql alongside the /api/v3 REST API.
+        self.graphqlURL = os.getenv('GHE_GRAPHQLURL', re.sub(r'/v3/?$', '/graphql', self.apiURL))
+        self.org = org or os.getenv('GHE_ORG', self.org)
         self._token = os.getenv('GHE_TOKEN', self._token)
         if self._token:
             self.github_headers['Authorization'] = 'token ' + self._token
         self.doUpdates = False if os.getenv('GHE_DRYRUN') else True
+        self.workers = int(os.getenv('GHE_WORKERS', self.workers))
+        self.auditBackend = os.getenv('GHE_AUDIT', self.auditBackend)
+        self.cacheDir = None if os.getenv('GHE_NOCACHE') else os.getenv('GHE_CACHE', self.cacheDir)
+        self.metricsPrefix = os.getenv('GHE_METRICS', self.metricsPrefix)
+        self.tracePath = os.getenv('GHE_TRACE', self.tracePath)
+        # A journal or inventory passed in (e.g. shared by several orgs) is used instead of opening GHE_JOURNAL / GHE_INVENTORY.
+        if journal:
+            self.journal = journal
+        elif os.getenv('GHE_JOURNAL'):
+            self.journal = gheJournal(os.getenv('GHE_JOURNAL'))
+        if inventory:
+            self.inventory = inventory
+        elif os.getenv('GHE_INVENTORY'):
+            self.inventory = gheInventory(os.getenv('GHE_INVENTORY'))
 
     def _getSession(self):
         if not self._token:
@@ -54,42 +729,91 @@ class manageGHE:
         if not self.org:
             self.logger.error("Github org must be set first. 'export GHE_ORG=CPSCNNN_YYYYS-TN' is recommended.")
             return None
-        mySession = requests.Session()
+        # Metrics of the most recent operation stay available as m.metrics.
+        self.metrics = gheMetrics(self.tracePath, self.apiURL)
+        mySession = gheSession(cacheDir=self.cacheDir, maxConcurrency=self.workers, logger=self.logger,
+                               metrics=self.metrics, metricsPrefix=self.metricsPrefix, adapter=self.adapter)
         mySession.headers.update(self.github_headers)
+        if not self.adapter:
+            # Worker threads share this session, so size the connection pool to match.
+            adapter = HTTPAdapter(pool_connections=self.workers, pool_maxsize=self.workers)
+            mySession.mount('https://', adapter)
+            mySession.mount('http://', adapter)
+        if self.rateReserve is not None:
+            mySession.rateReserve = self.rateReserve
         return mySession
 
+    def _paginate(self, s, url, parse=None, prefetch=True, phase='listing'):
+        """ Generator over the pages of the listing at {url}, requested 100 items at a time. Each page is yielded,
+        parsed by {parse} (default: the JSON list), as soon as it is in. With {prefetch}, once the first page tells
+        the last page number (rel="last") the remaining pages are fetched concurrently by up to {workers} threads,
+        and still yielded in order. A page that can't be fetched is logged and yielded as None, ending the listing. """
+
+        parse = parse or (lambda r: r.json())
+
+        def fetch(myURL):
+            r = s.get(myURL, phase=phase)
+            if r.status_code != 200:
+                self.logger.error("%s status_code %s", myURL, r.status_code)
+                return None, {}
+            return parse(r), r.links
+
+        # https://docs.github.com/en/enterprise-server@2.21/rest/guides/traversing-with-pagination
+        parts = urlsplit(url)
+        myURL = urlunsplit(parts._replace(query=urlencode({ **dict(parse_qsl(parts.query)), 'per_page': 100 })))
+        page, links = fetch(myURL)
+        yield page
+        if page is None:
+            return
+
+        last = urlsplit(links.get('last', {}).get('url', ''))
+        lastQuery = dict(parse_qsl(last.query))
+        if prefetch and lastQuery.get('page', '').isdigit():
+            pool = ThreadPoolExecutor(max_workers=self.workers)
+            try:
+                futures = [ pool.submit(fetch, urlunsplit(last._replace(query=urlencode({ **lastQuery, 'page': n }))))
+                            for n in range(2, int(lastQuery['page']) + 1) ]
+                for future in futures:
+                    page, _ = future.result()
+                    yield page
+                    if page is None:
+                        return
+            finally:
+                # The consumer may stop early; don't fetch pages nobody will read.
+                pool.shutdown(cancel_futures=True)
+            return
+
+        while 'next' in links:
+            page, links = fetch(links['next']['url'])
+            yield page
+            if page is None:
+                return
+
     def getTeamMembership(self, team):
         """ Grab the current list of users of a team in your org. """
 
         with self._getSession() as s:
-
-            myURL = f"{self.apiURL}/orgs/{self.org}/teams/{team}/members"
-            users = {}
-            while True:
-                r = s.get(myURL)
-                if r.status_code == 200:
-                    for item in r.json():
-                        if item['type'] == 'User':
-                            users[item['login']] = item
-
-                    # https://docs.github.com/en/enterprise-server@2.21/rest/guides/traversing-with-pagination
-                    if 'Link' in r.headers:
-                        links = { x.split(';')[1].strip() : x.split(';')[0].strip(' <>') for x in r.headers['Link'].split(',') }
-                    else:
-                        links = {}
-                    if 'rel="next"' in links:
-                        myURL = links['rel="next"']
-                    else:
-                        return list(users.keys())
-                else:
-                    self.logger.error("%s status_code: %s", myURL, r.status_code)
+            users = []
+            for page in self._paginate(s, f"{self.apiURL}/orgs/{self.org}/teams/{team}/members"):
+                if page is None:
                     return None
-
+                users += [ item['login'] for item in page if item['type'] == 'User' ]
+            return users
 
 
     def createAssnRepos(self, assn, users, template=None, userPerms='pull'):
         """ Create assignment {assn} for list {users}, optionally using repo {template}.
-        Default permissions set to read for staff and user. """
+        Default permissions set to read for staff and user.
+        Repos are created concurrently by up to {workers} threads (GHE_WORKERS); a failed repo
+        is logged and skipped. Returns a dict of repo name -> True/False (created OK). """
+
+        results = self.createAssnReposBatch([assn], users, templates={ assn: template } if template else None, userPerms=userPerms)
+        return results[assn] if results is not None else None
+
+    def createAssnReposBatch(self, assns, users, templates=None, userPerms='pull'):
+        """ Create several assignments at once for list {users}, listing the org only once.
+        {templates} optionally maps an assignment name to its template repo.
+        Returns a dict of assignment -> (dict of repo name -> True/False). """
 
         if not self.doUpdates:
             self.logger.warning("DRY RUN - NO CHANGES WILL BE MADE")
@@ -103,7 +827,7 @@ class manageGHE:
             self.logger.error("users needs to be a list")
             return
 
-        allRepos = { f"{assn}_{user}" : user for user in users }
+        templates = templates or {}
 
         with self._getSession() as s:
             # Grab the 'staff' team id for setting permissions later.
@@ -114,7 +838,8 @@ class manageGHE:
                 return
             staff_team_id = r.json()['id']
 
-            if template:
+            templateHasBranches = {}
+            for template in set(templates.values()):
                 r = s.get(f"{self.apiURL}/repos/{template}", headers={'Accept': 'application/vnd.github.baptiste-preview+json'})
                 if r.status_code != 200:
                     self.logger.error("template %s is not a repo. Status code = %s. Should be of the form 'owner/repo'",
@@ -123,272 +848,1110 @@ class manageGHE:
                 if not r.json()['is_template']:
                     self.logger.error("%s is not a 'template' repo.", template)
                     return
+                # Repos generated from an empty template never get a branch, so there is nothing to wait for.
+                r = s.get(f"{self.apiURL}/repos/{template}/branches?per_page=1")
+                templateHasBranches[template] = r.status_code == 200 and bool(r.json())
 
-            # Lookup all current repos
-            myURL = f"{self.apiURL}/orgs/{self.org}/repos"
-            repos = {}
-            while True:
-                r = s.get(myURL)
-                if r.status_code == 200:
-                    for item in r.json():
-                        if item['name'].startswith(f"{assn}_"):
-                            repos[item['name']] = item
-
-                    # https://docs.github.com/en/enterprise-server@2.21/rest/guides/traversing-with-pagination
-                    if 'Link' in r.headers:
-                        links = { x.split(';')[1].strip() : x.split(';')[0].strip(' <>') for x in r.headers['Link'].split(',') }
-                    else:
-                        links = {}
-                    if 'rel="next"' in links:
-                        myURL = links['rel="next"']
-                    else:
-                        break
-                else:
-                    self.logger.error("%s status_code %s", myURL, r.status_code)
-                    return None
+            # Lookup all current repos. An incremental inventory refresh can't see deletions, and a repo wrongly
+            # thought to exist would never be created, so creation always takes a full listing.
+            allItems = self._listOrgRepos(s, full=True)
+            if allItems is None:
+                return None
+            existing = self._bucketRepos(allItems, assns)
 
-            # These are the missing repos to create
-            reposToCreate = allRepos.keys() - repos.keys()
+            results = {}
+            for assn in assns:
+                # These are the missing repos to create
+                allRepos = { f"{assn}_{user}" : user for user in users }
+                reposToCreate = allRepos.keys() - existing[assn].keys()
+                op = f"create:{self.org}:{assn}"
+                if self.journal and self.doUpdates:
+                    # Repos a previous run created but didn't finish adding the collaborator to.
+                    reposToCreate |= { repo for repo in self.journal.doneKeys(op, 'create')
+                                       if repo in allRepos and not self.journal.done(op, repo, 'collaborator') }
+                template = templates.get(assn)
+                results[assn] = self._createRepos(s, { repo : allRepos[repo] for repo in reposToCreate },
+                                                  template, staff_team_id, userPerms, op, waitReady=templateHasBranches.get(template, False))
+            return results
 
-            for repo in reposToCreate:
-                # Create a repo.
+    def _createRepos(self, s, reposToCreate, template, staff_team_id, userPerms, op=None, waitReady=False):
+        """ Concurrently create each repo in {reposToCreate} (repo name -> user). Returns repo name -> True/False.
+        Repos generated from a {template} go through the staged pipeline in _createReposPipelined(). """
+
+        s.metrics.phase = 'apply'
+        if template and self.doUpdates:
+            results = self._createReposPipelined(s, reposToCreate, template, userPerms, op, waitReady)
+        else:
+            results = {}
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                futures = { pool.submit(self._createRepo, s, repo, user, template, staff_team_id, userPerms, op) : repo
+                            for repo, user in sorted(reposToCreate.items()) }
+                for future in as_completed(futures):
+                    repo = futures[future]
+                    try:
+                        results[repo] = future.result()
+                    except Exception:
+                        # e.g. a connection error on the POST, which isn't retried: only this repo fails.
+                        self.logger.exception("creating repo %s failed", repo)
+                        if self.journal and op and self.doUpdates:
+                            step = 'collaborator' if self.journal.done(op, repo, 'create') else 'create'
+                            self.journal.record(op, repo, step, ok=False)
+                        results[repo] = False
+
+        failed = sorted(repo for repo, ok in results.items() if not ok)
+        if self.journal and op and self.doUpdates and not failed:
+            self.journal.complete(op)
+        self.logger.info("createAssnRepos complete: %s created, %s failed", len(results) - len(failed), len(failed))
+        if failed:
+            self.logger.error("Failed to create: %s", ', '.join(failed))
+        return results
+
+    def _createReposPipelined(self, s, reposToCreate, template, userPerms, op=None, waitReady=True):
+        """ Generate repos from {template} in three stages, each with its own queue and worker pool ({stageWorkers}):
+        generate, wait until the new repo's branches exist (generation is asynchronous, so a repo is empty for a
+        while after the generate call returns), then add the collaborator. Each repo moves on to the next stage
+        as soon as it finishes the previous one. Returns repo name -> True/False. """
+
+        journal = self.journal if op else None
+        workers = { stage : self.workers for stage in ('generate', 'ready', 'collaborator') }
+        workers.update(self.stageWorkers or {})
+        pools = { stage : ThreadPoolExecutor(max_workers=n, thread_name_prefix=stage) for stage, n in workers.items() }
+        done = { repo : Future() for repo in reposToCreate }
+
+        def stage(fn):
+            # A stage that raises must still resolve its repo, or the wait below would never end.
+            def run(repo, *args):
+                try:
+                    fn(repo, *args)
+                except Exception:
+                    self.logger.exception("creating repo %s failed", repo)
+                    if not done[repo].done():
+                        done[repo].set_result(False)
+            return run
+
+        @stage
+        def generate(repo):
+            created = journal.done(op, repo, 'create') if journal else None
+            if created:
+                self.logger.info("resuming repo: %s", repo)
+                repoURL = created['data']['url']
+            else:
                 self.logger.info("creating repo: %s", repo)
-                if self.doUpdates:
-                    # https://docs.github.com/en/enterprise-server@2.21/rest/reference/repos#create-an-organization-repository
-                    myURL = f"{self.apiURL}/orgs/{self.org}/repos"
-                    payload = {
-                        'name': repo,
-                        'team_id': staff_team_id,
-                        'private': True,
-                        'owner': self.org,
-                    }
-                    if template:
-                        # The template API doesn't support setting the team.
-                        del payload['team_id']
-                        myURL = f"{self.apiURL}/repos/{template}/generate"
-                        r = s.post(myURL, json=payload, headers={'Accept': 'application/vnd.github.baptiste-preview+json'})
-                    else:
-                        r = s.post(myURL, json=payload)
-                    if r.status_code == 201:
-                        self.logger.debug("created repo %s", repo)
-                    else:
-                        self.logger.critical("%s status_code %s", myURL, r.status_code)
-                        return None
+                repoURL = self._postRepo(s, repo, template, None, op)
+                if repoURL is None:
+                    return done[repo].set_result(False)
+            if waitReady and not (journal and journal.done(op, repo, 'ready')):
+                pools['ready'].submit(ready, repo, repoURL)
+            else:
+                pools['collaborator'].submit(collaborator, repo, repoURL)
 
-                    # Set permissions on (add collaborators to) the newly created repo.
-                    repoURL = r.json()['url']
-                    payload = { 'permission' : userPerms }
-                    myURL = f"{repoURL}/collaborators/{allRepos[repo]}"
-                    r = s.put(myURL, json=payload)
-                    if r.status_code == 201:
-                        self.logger.info("Permissions: %s@%s set to %s. (Invitation sent)", allRepos[repo], repo, userPerms)
-                    elif r.status_code == 204:
-                        # The docs say 204 is "when person is already a collaborator", but that doesn't seems to be entirely true.
-                        # Seems you get this message if permissions are simply set and no invitation sent.
-                        self.logger.info("Permissions: %s@%s set to %s.", allRepos[repo], repo, userPerms)
-                    else:
-                        self.logger.critical("%s status_code %s", myURL, r.status_code)
-                        return None
+        @stage
+        def ready(repo, repoURL):
+            if self._waitReady(s, repo, repoURL, op):
+                pools['collaborator'].submit(collaborator, repo, repoURL)
+            else:
+                done[repo].set_result(False)
+
+        @stage
+        def collaborator(repo, repoURL):
+            done[repo].set_result(self._addCollaborator(s, repo, repoURL, reposToCreate[repo], userPerms, op))
+
+        for repo in sorted(reposToCreate):
+            pools['generate'].submit(generate, repo)
+        results = {}
+        repoCount = len(done)
+        for rCount, repo in enumerate(as_completed({ future : repo for repo, future in done.items() }), 1):
+            if sys.stdout.isatty(): print(f"{rCount:04}/{repoCount}", end=' - generated              \r')
+        for repo, future in done.items():
+            results[repo] = future.result()
+        for pool in pools.values():
+            pool.shutdown()
+        return results
 
+    def _waitReady(self, s, repo, repoURL, op=None):
+        """ Poll a freshly generated repo until it has a branch, backing off from {readyInterval} up to 30s,
+        for at most {readyTimeout} seconds. Returns True once ready. """
 
+        # https://docs.github.com/en/enterprise-server@2.21/rest/reference/repos#list-branches
+        deadline = time.time() + self.readyTimeout
+        delay = self.readyInterval
+        while True:
+            r = s.get(f"{repoURL}/branches?per_page=1", cache=False)
+            if r.status_code == 200 and r.json():
+                self.logger.debug("repo %s is ready", repo)
+                if op and self.journal:
+                    self.journal.record(op, repo, 'ready')
+                return True
+            if r.status_code not in (200, 404, 409):
+                self.logger.critical("%s/branches status_code %s", repoURL, r.status_code)
+                return False
+            if time.time() + delay > deadline:
+                self.logger.critical("repo %s still empty %ss after generation", repo, self.readyTimeout)
+                return False
+            time.sleep(delay)
+            delay = min(delay * 2, 30)
 
+    def _createRepo(self, s, repo, user, template, staff_team_id, userPerms, op=None):
+        """ Create a single {repo} and add {user} as a collaborator. Run from a worker thread.
+        Each step is recorded in the journal (if any) under {op}, and steps already done are skipped.
+        Returns True on success, False (after logging) on failure. """
 
-    def setAssnPerms(self, assn, assnRE=None, userPerms=None, staffPerms=None, adminPerms=None):
-        """ Query perms for all assignment {assn} and update perms. """
+        journal = self.journal if op else None
+        created = journal.done(op, repo, 'create') if journal else None
+        if created and self.doUpdates:
+            self.logger.info("resuming repo: %s", repo)
+            return self._addCollaborator(s, repo, created['data']['url'], user, userPerms, op)
+
+        # Create a repo.
+        self.logger.info("creating repo: %s", repo)
+        if not self.doUpdates:
+            return True
+        repoURL = self._postRepo(s, repo, template, staff_team_id, op)
+        if repoURL is None:
+            return False
+        return self._addCollaborator(s, repo, repoURL, user, userPerms, op)
+
+    def _postRepo(self, s, repo, template, staff_team_id, op=None):
+        """ Create (or generate from {template}) {repo}. Returns the new repo's API url, or None (after logging) on failure. """
+
+        # https://docs.github.com/en/enterprise-server@2.21/rest/reference/repos#create-an-organization-repository
+        myURL = f"{self.apiURL}/orgs/{self.org}/repos"
+        payload = {
+            'name': repo,
+            'team_id': staff_team_id,
+            'private': True,
+            'owner': self.org,
+        }
+        if template:
+            # The template API doesn't support setting the team.
+            del payload['team_id']
+            myURL = f"{self.apiURL}/repos/{template}/generate"
+            r = s.post(myURL, json=payload, headers={'Accept': 'application/vnd.github.baptiste-preview+json'})
+        else:
+            r = s.post(myURL, json=payload)
+        if r.status_code == 201:
+            self.logger.debug("created repo %s", repo)
+        else:
+            self.logger.critical("%s (%s) status_code %s", myURL, repo, r.status_code)
+            if op and self.journal:
+                self.journal.record(op, repo, 'create', ok=False)
+            return None
+        repoURL = r.json()['url']
+        if op and self.journal:
+            self.journal.record(op, repo, 'create', data={ 'url': repoURL })
+        return repoURL
+
+    def _addCollaborator(self, s, repo, repoURL, user, userPerms, op=None):
+        """ Set permissions on (add collaborators to) a newly created repo. Returns True on success. """
+
+        payload = { 'permission' : userPerms }
+        myURL = f"{repoURL}/collaborators/{user}"
+        r = s.put(myURL, json=payload)
+        if r.status_code == 201:
+            self.logger.info("Permissions: %s@%s set to %s. (Invitation sent)", user, repo, userPerms)
+        elif r.status_code == 204:
+            # The docs say 204 is "when person is already a collaborator", but that doesn't seems to be entirely true.
+            # Seems you get this message if permissions are simply set and no invitation sent.
+            self.logger.info("Permissions: %s@%s set to %s.", user, repo, userPerms)
+        else:
+            self.logger.critical("%s status_code %s", myURL, r.status_code)
+            if op and self.journal:
+                self.journal.record(op, repo, 'collaborator', ok=False)
+            return False
+        if op and self.journal:
+            self.journal.record(op, repo, 'collaborator')
+        return True
+
+    def setAssnPerms(self, assn, assnRE=None, userPerms=None, staffPerms=None, adminPerms=None, planFile=None):
+        """ Query perms for all assignment {assn} and update perms.
+        Each repo's permission state is fetched once, diffed against the requested perms into a plan,
+        and the plan is then applied concurrently. If {planFile} is given (or on a dry run, where it
+        defaults to '{org}_{assn}_plan.json') the plan is also written out as JSON; it can be
+        reviewed and later applied with applyPlan() without re-auditing. Returns the plan. """
+
+        return self.setAssnPermsBatch({ assn: assnRE }, userPerms=userPerms, staffPerms=staffPerms, adminPerms=adminPerms, planFile=planFile)
+
+    def setAssnPermsBatch(self, assns, userPerms=None, staffPerms=None, adminPerms=None, planFile=None):
+        """ setAssnPerms() for several assignments at once, listing the org and auditing in a single pass.
+        {assns} is a list of assignment names, or a dict of assignment name -> regular expression (None for the default).
+        The plan file defaults to '{org}_{assn1}+{assn2}..._plan.json'. Returns the combined plan; once applied, its
+        'failed' entry lists the changes that failed. """
 
         if not self.doUpdates:
             self.logger.warning("DRY RUN - NO CHANGES WILL BE MADE")
 
         # https://docs.github.com/en/enterprise-server@2.21/rest/reference/repos#add-a-repository-collaborator
-        if userPerms:
-            if userPerms not in {'pull', 'push', 'admin'}:
-                self.logger.error("Invalid userPerms")
+        for name, perms in (('userPerms', userPerms), ('staffPerms', staffPerms), ('adminPerms', adminPerms)):
+            if perms and perms not in {'pull', 'push', 'admin'}:
+                self.logger.error("Invalid %s", name)
                 return
-            userPermsPayload = { 'permission': userPerms }
-            userPermsD = {
-                "admin": True if userPerms == 'admin' else False,
-                "push": True if userPerms in ['admin', 'push'] else False,
-                "pull": True,
-            }
-        if staffPerms:
-            if staffPerms not in {'pull', 'push', 'admin'}:
-                self.logger.error("Invalid staffPerms")
+        if not isinstance(assns, dict):
+            assns = dict.fromkeys(assns)
+        for assn, assnRE in assns.items():
+            self.logger.info("assignment %s regular expression used: %s", assn, assnRE or fr"^{assn}_\S+$")
+
+        with self._getSession() as s:
+            teamRepos = self._teamRepositoriesURLs(s, staffPerms, adminPerms)
+            if teamRepos is None:
                 return
-            staffPermsPayload = { 'permission': staffPerms }
-            staffPermsD = {
-                "admin": True if staffPerms == 'admin' else False,
-                "maintain": False,
-                "push": True if staffPerms in ['admin', 'push'] else False,
-                "triage": False,
-                "pull": True,
+
+            # Lookup all current repos. Each page's repos are audited as soon as it is in, while later pages are still listed.
+            repos = {}
+            found = dict.fromkeys(assns, 0)
+            listedCount = 0
+            listFailed = False
+
+            def listed():
+                nonlocal listedCount, listFailed
+                for page in [ self._listOrgRepos(s) ] if self.inventory else self._iterOrgRepos(s):
+                    if page is None:
+                        listFailed = True
+                        return
+                    listedCount += len(page)
+                    matches = {}
+                    for assn, matched in self._bucketRepos(page, assns).items():
+                        found[assn] += len(matched)
+                        matches.update(matched)
+                    fresh = [ item.full_name for name, item in matches.items() if name not in repos ]
+                    repos.update(matches)
+                    yield from fresh
+
+            # The desired perms are part of the op, so a rerun asking for different perms doesn't resume this one.
+            op = f"perms:{self.org}:{'+'.join(assns)}:{userPerms}:{staffPerms}:{adminPerms}" if self.journal and self.doUpdates else None
+            self.logger.info("Inspecting repository permissions.")
+            # Per-repo collaborators and teams are only needed for userPerms; staff + admin are audited team-wide below.
+            states = self._auditRepos(s, listed(), collaborators=bool(userPerms), teams=bool(userPerms), op=op)
+            if listFailed:
+                return None
+            for assn, count in found.items():
+                self.logger.info("Found %s repositories for %s out of %s", count, assn, listedCount)
+            repoCount = len(repos)
+            if states is None:
+                return None
+            teamPerms = {}
+            for team, team_repos in teamRepos.items():
+                self.logger.info("Inspecting %s team permissions.", team)
+                teamPerms[team] = self._teamRepoPerms(s, team_repos)
+                if teamPerms[team] is None:
+                    return None
+
+            plan = {
+                'org': self.org,
+                'assns': { assn : assnRE or fr"^{assn}_\S+$" for assn, assnRE in assns.items() },
+                'changes': self._planPerms(states, teamRepos, teamPerms, userPerms, staffPerms, adminPerms),
             }
-        if adminPerms:
-            if adminPerms not in {'pull', 'push', 'admin'}:
-                self.logger.error("Invalid adminPerms")
+            self.logger.info("Plan: %s permission changes over %s repositories", len(plan['changes']), repoCount)
+
+            if planFile is None and not self.doUpdates:
+                planFile = f"{self.org}_{'+'.join(assns)}_plan.json"
+            if planFile:
+                with open(planFile, 'w') as f:
+                    json.dump(plan, f, indent=1)
+                self.logger.info("Plan written to %s", planFile)
+
+            if self.doUpdates:
+                plan['failed'] = self._applyChanges(s, plan['changes'], op)
+                if op and not plan['failed']:
+                    self.journal.complete(op)
+
+        self.logger.info("setAssnPerms complete")
+        return plan
+
+    def watchAssnPerms(self, assns, userPerms=None, staffPerms=None, adminPerms=None, cursorFile=None, polls=None):
+        """ Long-running setAssnPermsBatch(): keep the perms of assignments {assns} correct as TAs change them by hand.
+        After one full sweep, the org's events as seen by the token's user (so private repos are included), and its audit
+        log where the server has one, are polled with ETags at the interval the server asks for, and only repos touched
+        by collaborator, team or repository events are re-audited and fixed. Changes to an existing permission only show
+        up in the audit log (GHES 3.0+); from events alone, only added collaborators, added teams and new repos are seen. The last event processed is kept in {cursorFile} (default '{org}_{assn1}+{assn2}..._watch.json');
+        a restarted watch resumes from it without another sweep. Runs for {polls} polls, or until interrupted.
+        Returns the totals: { 'polls', 'audited', 'changes', 'failed' }. """
+
+        # https://docs.github.com/en/enterprise-server@2.21/rest/reference/repos#add-a-repository-collaborator
+        for name, perms in (('userPerms', userPerms), ('staffPerms', staffPerms), ('adminPerms', adminPerms)):
+            if perms and perms not in {'pull', 'push', 'admin'}:
+                self.logger.error("Invalid %s", name)
                 return
-            adminPermsPayload = { 'permission': adminPerms }
-            adminPermsD = {
-                "admin": True if adminPerms == 'admin' else False,
-                "maintain": False,
-                "push": True if adminPerms in ['admin', 'push'] else False,
-                "triage": False,
-                "pull": True,
-            }
-        if assnRE is None:
-            assnRE = fr"^{assn}_\S+$"
-        self.logger.info("assignment regular expression used: %s", assnRE)
-        assnPattern = re.compile(assnRE)
+        if not isinstance(assns, dict):
+            assns = dict.fromkeys(assns)
+        cursorFile = cursorFile or f"{self.org}_{'+'.join(assns)}_watch.json"
+        try:
+            with open(cursorFile) as f:
+                cursor = json.load(f)
+        except FileNotFoundError:
+            cursor = None
 
+        totals = { 'polls': 0, 'audited': 0, 'changes': 0, 'failed': 0 }
         with self._getSession() as s:
-            if staffPerms:
-                # Grab the 'staff' team id for setting permissions later.
-                myURL = f"{self.apiURL}/orgs/{self.org}/teams/staff"
+            teamRepos = self._teamRepositoriesURLs(s, staffPerms, adminPerms)
+            if teamRepos is None:
+                return None
+            # The org's public events feed leaves out private repos; the authenticated user's view of it includes them.
+            # https://docs.github.com/en/enterprise-server@2.21/rest/reference/users#get-the-authenticated-user
+            r = s.get(f"{self.apiURL}/user")
+            if r.status_code != 200:
+                self.logger.error("%s/user status_code %s", self.apiURL, r.status_code)
+                return None
+            # https://docs.github.com/en/enterprise-server@2.21/rest/reference/activity#list-organization-events-for-the-authenticated-user
+            feeds = { 'events': (f"{self.apiURL}/users/{r.json()['login']}/events/orgs/{self.org}?per_page=100", lambda event: int(event['id']),
+                                 lambda event: event['repo']['name'] if event['type'] in self.watchEvents else None) }
+            # https://docs.github.com/en/enterprise-server@3.0/rest/reference/orgs#get-the-audit-log-for-an-organization
+            auditURL = f"{self.apiURL}/orgs/{self.org}/audit-log?per_page=100&order=desc"
+            if s.get(auditURL, cache=False, phase='watch').status_code == 200:
+                feeds['auditlog'] = (auditURL, lambda entry: int(entry['@timestamp']),
+                                     lambda entry: entry.get('repo') if entry.get('action') in self.watchActions else None)
+            else:
+                self.logger.warning("No audit log API on this server: only added collaborators, added teams and new repos can be "
+                                    "seen in org events, so permissions changed by hand will NOT be detected")
+
+            if cursor is None:
+                # Mark where the feeds are before the sweep, so nothing that happens during it is missed.
+                cursor = {}
+                for name, (url, position, touched) in feeds.items():
+                    if self._pollFeed(s, url, cursor.setdefault(name, {}), position)[0] is None:
+                        return None
+                if self.setAssnPermsBatch(assns, userPerms, staffPerms, adminPerms) is None:
+                    return None
+                self._saveCursor(cursorFile, cursor)
+
+            self.logger.info("Watching %s for permission changes", self.org)
+            try:
+                while polls is None or totals['polls'] < polls:
+                    fullNames = set()
+                    interval = 0
+                    for name, (url, position, touched) in feeds.items():
+                        entries, wait = self._pollFeed(s, url, cursor.setdefault(name, {}), position)
+                        interval = max(interval, wait)
+                        fullNames.update(owner_name for owner_name in map(touched, entries or []) if owner_name)
+                    totals['polls'] += 1
+
+                    items = [ gheRepo(owner_name.split('/', 1)[1], owner_name, f"{self.apiURL}/repos/{owner_name}")
+                              for owner_name in fullNames if owner_name.startswith(f"{self.org}/") ]
+                    repos = {}
+                    for matched in self._bucketRepos(items, assns).values():
+                        repos.update(matched)
+                    if repos:
+                        self.logger.info("Watch: %s repositories touched, re-auditing", len(repos))
+                        # A handful of repos: their own team lists are cheaper than paging the staff/admin teams.
+                        s.metrics.phase = 'audit'
+                        states = self._auditReposREST(s, [ item.full_name for item in repos.values() ],
+                                                      collaborators=bool(userPerms), teams=True)
+                        # Repos deleted since the event (or otherwise unreadable) were logged by the audit; skip them.
+                        states = { owner_name : state for owner_name, state in self._dropGone(states).items() if state is not None }
+                        if self.inventory:
+                            self.inventory.saveStates(self.org, states, bool(userPerms), True)
+                        teamPerms = { team : { owner_name : state['teams'][team][0] for owner_name, state in states.items()
+                                               if team in state['teams'] } for team in teamRepos }
+                        changes = self._planPerms(states, teamRepos, teamPerms, userPerms, staffPerms, adminPerms)
+                        totals['audited'] += len(states)
+                        totals['changes'] += len(changes)
+                        if self.doUpdates:
+                            totals['failed'] += len(self._applyChanges(s, changes))
+                    self._saveCursor(cursorFile, cursor)
+                    if polls is None or totals['polls'] < polls:
+                        time.sleep(interval)
+            except KeyboardInterrupt:
+                self.logger.info("Watch interrupted")
+
+        self.logger.info("watchAssnPerms complete: %s polls, %s repositories audited, %s changes, %s failed",
+                         totals['polls'], totals['audited'], totals['changes'], totals['failed'])
+        return totals
+
+    def _pollFeed(self, s, url, state, position):
+        """ Read the entries of an org feed (events or audit log, newest first) at {url} that are newer than the last one
+        processed. {state} keeps the feed's ETag, so an unchanged feed costs a free 304, and the {position} of the newest
+        entry seen. With no position yet, only that is recorded. Returns (new entries, seconds the server asks to wait
+        before the next poll); entries is None (after logging) on error. """
+
+        headers = { 'If-None-Match': state['etag'] } if state.get('etag') else None
+        r = s.get(url, headers=headers, cache=False, phase='watch')
+        interval = float(r.headers.get('X-Poll-Interval', self.watchInterval))
+        if r.status_code == 304:
+            return [], interval
+        if r.status_code != 200:
+            self.logger.error("%s status_code %s", url, r.status_code)
+            return None, interval
+        state['etag'] = r.headers.get('ETag')
+
+        last = state.get('position')
+        entries = []
+        while True:
+            page = r.json()
+            new = [ entry for entry in page if last is None or position(entry) > last ]
+            entries += new
+            # Stop at the first page reaching entries already processed.
+            if last is None or len(new) < len(page) or 'next' not in r.links:
+                break
+            myURL = r.links['next']['url']
+            r = s.get(myURL, cache=False, phase='watch')
+            if r.status_code != 200:
+                self.logger.error("%s status_code %s", myURL, r.status_code)
+                return None, interval
+        if entries:
+            state['position'] = max(map(position, entries))
+        elif last is None:
+            # An empty feed: everything from now on is new.
+            state['position'] = 0
+        return [] if last is None else entries, interval
+
+    @staticmethod
+    def _saveCursor(cursorFile, cursor):
+        # Write to a temporary file and rename, so an interrupted watch never leaves a partial cursor.
+        with open(f"{cursorFile}.tmp", 'w') as f:
+            json.dump(cursor, f)
+        os.replace(f"{cursorFile}.tmp", cursorFile)
+
+    def _teamRepositoriesURLs(self, s, staffPerms=None, adminPerms=None):
+        """ The repositories url of the staff and/or admin team, for whichever perms are set. Returns { team : url },
+        or None (after logging) if a team is missing. """
+
+        teamRepos = {}
+        for team, perms in (('staff', staffPerms), ('admin', adminPerms)):
+            if perms:
+                # Grab the team's repositories url for setting permissions later.
+                myURL = f"{self.apiURL}/orgs/{self.org}/teams/{team}"
                 r = s.get(myURL)
                 if r.status_code != 200:
-                    self.logger.error("Required 'staff' team was not found in the %s organization. Please create manually.", self.org)
-                    return
-                staff_team_repos = r.json()['repositories_url']
-            if adminPerms:
-                # Grab the 'admin' team id for setting permissions later.
-                myURL = f"{self.apiURL}/orgs/{self.org}/teams/admin"
-                r = s.get(myURL)
+                    self.logger.error("Required '%s' team was not found in the %s organization. Please create manually.", team, self.org)
+                    return None
+                teamRepos[team] = r.json()['repositories_url']
+        return teamRepos
+
+    def _listOrgRepos(self, s, full=False):
+        """ Every repo in the org, from the inventory (refreshed first, {full}y if asked) if there is one, otherwise from the API.
+        Returns a list of gheRepo records, or None (after logging) on error. """
+
+        if self.inventory:
+            if not self.refreshInventory(s, full):
+                return None
+            return self.inventory.repos(self.org)
+        return self._pageOrgRepos(s)
+
+    def _pageOrgRepos(self, s, since=None):
+        """ Page through the org's repos, as gheRepo records. With {since}, repos are listed most recently updated first and paging
+        stops at the first page reaching repos not updated after {since}. """
+
+        items = []
+        for page in self._iterOrgRepos(s, since):
+            if page is None:
+                return None
+            items += page
+        return items
+
+    def _iterOrgRepos(self, s, since=None):
+        """ Generator version of _pageOrgRepos(): yields each page of gheRepo records as it arrives, or None on error. """
+
+        myURL = f"{self.apiURL}/orgs/{self.org}/repos"
+        if since:
+            myURL += "?sort=updated&direction=desc"
+        count = 0
+        # Pages sorted by update time are read one at a time, since the listing usually stops after the first.
+        for page in self._paginate(s, myURL, parse=lambda r: gheRepo.parsePage(r.content), prefetch=not since):
+            yield page
+            if page is None:
+                return
+            count += len(page)
+            if sys.stdout.isatty(): print(f"{count:04}", end=' - repo search              \r')
+            if since and page and page[-1].updated_at <= since:
+                return
+
+    def refreshInventory(self, s=None, full=False):
+        """ Bring the inventory's repo listing up to date. Normally only repos updated since the last refresh are
+        fetched; a {full} listing (also done when the last one is older than {inventoryMaxAge}) picks up deletions.
+        Returns True on success. """
+
+        if s is None:
+            with self._getSession() as s:
+                return self.refreshInventory(s, full)
+
+        lastFull = self.inventory.getMeta(self.org, 'full_refresh')
+        since = self.inventory.latest(self.org)
+        if full or since is None or lastFull is None or time.time() - float(lastFull) > self.inventoryMaxAge:
+            started = time.time()
+            items = self._pageOrgRepos(s)
+            if items is None:
+                return False
+            self.inventory.saveRepos(self.org, items, full=True)
+            self.inventory.setMeta(self.org, 'full_refresh', str(started))
+            self.logger.info("Inventory: indexed %s repositories", len(items))
+        else:
+            items = self._pageOrgRepos(s, since=since)
+            if items is None:
+                return False
+            self.inventory.saveRepos(self.org, items)
+            self.logger.debug("Inventory: %s repositories updated since %s", len(items), since)
+        return True
+
+    @staticmethod
+    def _bucketRepos(items, assns):
+        """ Sort repo listing {items} by assignment. {assns} is a list of assignment names, or a dict of
+        assignment name -> regular expression (None for the default '{assn}_...').
+        Default assignments are found with a prefix index (a set lookup per '_' in the repo name) rather than
+        running a regex per repo per assignment. Returns { assn : { repo name : item } }. """
+
+        if not isinstance(assns, dict):
+            assns = dict.fromkeys(assns)
+        buckets = { assn : {} for assn in assns }
+        prefixes = { assn for assn, assnRE in assns.items() if not assnRE }
+        patterns = { assn : re.compile(assnRE) for assn, assnRE in assns.items() if assnRE }
+        for item in items:
+            name = item.name
+            i = name.find('_')
+            while 0 < i < len(name) - 1:
+                if name[:i] in prefixes:
+                    buckets[name[:i]][name] = item
+                i = name.find('_', i + 1)
+            for assn, pattern in patterns.items():
+                if pattern.match(name):
+                    buckets[assn][name] = item
+        return buckets
+
+    def applyPlan(self, planFile):
+        """ Apply a plan written by setAssnPerms() or reconcileClasslist() (typically during a dry run) without re-auditing. """
+
+        with open(planFile) as f:
+            plan = json.load(f)
+        if plan['org'] != self.org:
+            self.logger.error("Plan %s is for org %s, not %s", planFile, plan['org'], self.org)
+            return None
+        if not self.doUpdates:
+            self.logger.warning("DRY RUN - NO CHANGES WILL BE MADE")
+            return None
+
+        self.logger.info("Applying %s changes from %s", len(plan['changes']), planFile)
+        op = f"plan:{self.org}:{os.path.abspath(planFile)}" if self.journal else None
+        with self._getSession() as s:
+            failed = self._applyPlanChanges(s, plan['changes'], op)
+        if op and not failed:
+            self.journal.complete(op)
+        return failed
+
+    def reconcileClasslist(self, assn, team='students', userPerms='push', dropPerms='pull', template=None, planFile=None):
+        """ Bring assignment {assn} in line with the current membership of {team}, in one indexed pass:
+        late registrants get their repo created (optionally from {template}); enrolled students whose access to their
+        own repo isn't {userPerms} are fixed; students no longer in {team} are downgraded to {dropPerms}, or removed
+        as collaborators if {dropPerms} is None; repos that belong to no enrolled student and have no collaborator
+        of that name are reported as orphans. A student who hasn't accepted the invitation to their repo yet is
+        handled through the pending invitation (updated, or revoked with dropPerms None) instead. The change set is applied concurrently and, like setAssnPerms, written
+        to {planFile} (by default on a dry run) for applyPlan(). Returns the plan; once applied, its 'failed' entry
+        lists the changes that failed. """
+
+        if not self.doUpdates:
+            self.logger.warning("DRY RUN - NO CHANGES WILL BE MADE")
+        for name, perms in (('userPerms', userPerms), ('dropPerms', dropPerms)):
+            if perms and perms not in {'pull', 'push', 'admin'}:
+                self.logger.error("Invalid %s", name)
+                return
+
+        students = self.getTeamMembership(team)
+        if students is None:
+            return None
+        # Logins are case-insensitive on GitHub.
+        enrolled = { login.lower() : login for login in students }
+
+        with self._getSession() as s:
+            staff_team_id = None
+            if not template:
+                # Grab the 'staff' team id for creating repos later.
+                r = s.get(f"{self.apiURL}/orgs/{self.org}/teams/staff")
                 if r.status_code != 200:
-                    self.logger.error("Required 'admin' team was not found in the %s organization. Please create manually.", self.org)
+                    self.logger.error("Required 'staff' team was not found in the %s organization. Please create manually.", self.org)
                     return
-                admin_team_repos = r.json()['repositories_url']
+                staff_team_id = r.json()['id']
 
-            # Lookup all current repos
-            myURL = f"{self.apiURL}/orgs/{self.org}/repos"
-            repos = {}
-            rCount = 0
-            while True:
-                r = s.get(myURL)
-                if r.status_code == 200:
-                    for rCount, item in enumerate(r.json(), rCount+1):
-                        if sys.stdout.isatty(): print(f"{rCount:04}", end=' - repo search              \r')
-                        if assnPattern.match(item['name']):
-                            repos[item['name']] = item
-
-                    # https://docs.github.com/en/enterprise-server@2.21/rest/guides/traversing-with-pagination
-                    if 'Link' in r.headers:
-                        links = { x.split(';')[1].strip() : x.split(';')[0].strip(' <>') for x in r.headers['Link'].split(',') }
-                    else:
-                        links = {}
-                    if 'rel="next"' in links:
-                        myURL = links['rel="next"']
-                    else:
-                        break
+            allItems = self._listOrgRepos(s)
+            if allItems is None:
+                return None
+            repos = self._bucketRepos(allItems, [assn])[assn]
+            # Index repos by the (lowercased) login they were created for.
+            owners = { name[len(assn) + 1:].lower() : item for name, item in repos.items() }
+            self.logger.info("Found %s repositories for %s, %s students in %s", len(repos), assn, len(enrolled), team)
+
+            self.logger.info("Inspecting direct collaborators.")
+            states = self._auditRepos(s, [ item.full_name for item in repos.values() ], collaborators=True, teams=False)
+            if states is None:
+                return None
+            # Repos found to be deleted are treated as missing, so they are recreated.
+            owners = { login : item for login, item in owners.items() if item.full_name in states }
+            # Students who haven't accepted yet aren't collaborators, but will be once they do.
+            invitations = self._repoInvitations(s, [ item.full_name for item in owners.values() ])
+            if invitations is None:
+                return None
+
+            changes = []
+            orphans = []
+            for login in sorted(enrolled.keys() - owners.keys()):
+                changes.append({ 'repo': f"{self.org}/{assn}_{enrolled[login]}", 'kind': 'create', 'target': enrolled[login], 'was': None,
+                                 'permission': userPerms, 'template': template, 'team_id': staff_team_id,
+                                 'url': f"{self.apiURL}/orgs/{self.org}/repos" })
+            for login, item in sorted(owners.items()):
+                owner_name = item.full_name
+                collaborators = { collab.lower() : (collab, perm) for collab, perm in states[owner_name]['collaborators'].items() }
+                collab, perm = collaborators.get(login, (enrolled.get(login, login), None))
+                invitation = invitations[owner_name].get(login) if perm is None else None
+                if invitation:
+                    # https://docs.github.com/en/enterprise-server@2.21/rest/reference/repos#update-a-repository-invitation
+                    invitation_id, collab, perm = invitation
+                    url = f"{self.apiURL}/repos/{owner_name}/invitations/{invitation_id}"
                 else:
-                    self.logger.error("GHE API status code %s", r.status_code)
+                    url = f"{self.apiURL}/repos/{owner_name}/collaborators/{collab}"
+
+                def change(kind, permission):
+                    c = { 'repo': owner_name, 'kind': kind, 'target': collab, 'was': perm, 'permission': permission, 'url': url }
+                    if invitation:
+                        c.update({ 'invitation': invitation[0], 'method': 'PATCH' if permission else 'DELETE' })
+                        if permission:
+                            c['payload'] = { 'permissions': self._invitationNames[permission] }
+                    elif not permission:
+                        c['method'] = 'DELETE'
+                    return c
+
+                if login in enrolled:
+                    if perm != userPerms:
+                        changes.append(change('user', userPerms))
+                elif perm is None:
+                    orphans.append(owner_name)
+                elif dropPerms is None:
+                    changes.append(change('revoke', None))
+                elif perm != dropPerms:
+                    changes.append(change('drop', dropPerms))
+
+            for change in changes:
+                self.logger.info("Classlist: %s %s@%s -> %s. Was %s%s", change['kind'], change['target'], change['repo'], change['permission'],
+                                 change['was'], " (invitation)" if change.get('invitation') else '')
+            for owner_name in orphans:
+                self.logger.warning("Classlist: orphaned repo %s (no enrolled student or collaborator of that name)", owner_name)
+
+            plan = {
+                'org': self.org,
+                'assns': { assn : fr"^{assn}_\S+$" },
+                'changes': changes,
+                'orphans': orphans,
+            }
+            self.logger.info("Plan: %s classlist changes, %s orphaned repositories", len(changes), len(orphans))
+            if planFile is None and not self.doUpdates:
+                planFile = f"{self.org}_{assn}_classlist.json"
+            if planFile:
+                with open(planFile, 'w') as f:
+                    json.dump(plan, f, indent=1)
+                self.logger.info("Plan written to %s", planFile)
+
+            if self.doUpdates:
+                # The journal records each change's outcome. Every run re-audits and replans whatever is still wrong,
+                # so the op is completed even after failures rather than having later runs skip its done steps.
+                op = f"classlist:{self.org}:{assn}:{userPerms}:{dropPerms}" if self.journal else None
+                plan['failed'] = self._applyPlanChanges(s, changes, op)
+                if plan['failed']:
+                    self.logger.error("Classlist: %s of %s changes failed", len(plan['failed']), len(changes))
+                if op:
+                    for template in { change['template'] for change in changes if change['kind'] == 'create' }:
+                        self.journal.complete(f"{op}:create:{template}")
+                    self.journal.complete(op)
+
+        self.logger.info("reconcileClasslist complete")
+        return plan
+
+    def _applyPlanChanges(self, s, changes, op=None):
+        """ Apply planned changes: 'create' changes make the missing repos, everything else goes to _applyChanges().
+        Returns the list of changes that failed. """
+
+        failed = []
+        creates = [ change for change in changes if change['kind'] == 'create' ]
+        for template in { change['template'] for change in creates }:
+            batch = { change['repo'].split('/', 1)[1] : change for change in creates if change['template'] == template }
+            waitReady = False
+            if template:
+                r = s.get(f"{self.apiURL}/repos/{template}/branches?per_page=1")
+                waitReady = r.status_code == 200 and bool(r.json())
+            team_id = next(iter(batch.values()))['team_id']
+            userPerms = next(iter(batch.values()))['permission']
+            results = self._createRepos(s, { repo : change['target'] for repo, change in batch.items() }, template, team_id, userPerms,
+                                        f"{op}:create:{template}" if op else None, waitReady=waitReady)
+            failed += [ batch[repo] for repo, ok in results.items() if not ok ]
+        failed += self._applyChanges(s, [ change for change in changes if change['kind'] != 'create' ], op)
+        return failed
+
+    # Repository invitation permission names, as REST permission names, and back.
+    _invitationPerms = { 'read': 'pull', 'triage': 'triage', 'write': 'push', 'maintain': 'maintain', 'admin': 'admin' }
+    _invitationNames = { perm : name for name, perm in _invitationPerms.items() }
+
+    def _repoInvitations(self, s, fullNames):
+        """ Fetch the pending invitations of each repo in {fullNames}, concurrently.
+        Returns { full_name : { lowercased login : (invitation id, login, perm) } }, or None (after logging) on error. """
+
+        # https://docs.github.com/en/enterprise-server@2.21/rest/reference/repos#list-repository-invitations
+        def invitations(owner_name):
+            found = {}
+            for page in self._paginate(s, f"{self.apiURL}/repos/{owner_name}/invitations", phase='audit'):
+                if page is None:
                     return None
-            repoCount = len(repos)
-            self.logger.info("Found %s matching repositories out of %s", repoCount, rCount)
+                for item in page:
+                    if item.get('invitee'):
+                        found[item['invitee']['login'].lower()] = (item['id'], item['invitee']['login'],
+                                                                   self._invitationPerms.get(item['permissions'], item['permissions']))
+            return found
+
+        results = {}
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            futures = { pool.submit(invitations, owner_name) : owner_name for owner_name in fullNames }
+            for future in as_completed(futures):
+                try:
+                    results[futures[future]] = future.result()
+                except requests.RequestException as e:
+                    self.logger.error("%s invitations failed: %s", futures[future], e)
+                    results[futures[future]] = None
+        if None in results.values():
+            return None
+        return results
 
+    @staticmethod
+    def _permName(permissions):
+        """ Collapse a REST permissions dict ({'admin': True, 'push': True, 'pull': True}) to its highest permission. """
+        if permissions is None:
+            return None
+        for name in ('admin', 'maintain', 'push', 'triage', 'pull'):
+            if permissions.get(name):
+                return name
+        return None
+
+    def _auditRepos(self, s, fullNames, collaborators=True, teams=True, op=None):
+        """ Fetch the current permission state (direct {collaborators} and/or {teams}) of each repo in {fullNames}, concurrently.
+        {fullNames} may be a generator fed by a listing still in progress; repos are audited as they arrive.
+        Repos already audited under journal operation {op} are taken from the journal instead, unless changes were
+        (or may have been) applied to them since.
+        Returns { full_name : { 'collaborators': { login : perm }, 'teams': { slug : (perm, repositories_url) } } },
+        or None if any repo could not be audited. """
+
+        s.metrics.phase = 'audit'
+        journaled = self.journal.doneKeys(op, 'audit') if op else {}
+        if journaled:
+            applied = [ entry['data'] for entry in self.journal.entries(op, 'apply').values() ]
+            if None in applied:
+                # Apply entries from before they named their repo: any repo may have changed.
+                journaled = {}
+            else:
+                changed = { data['repo'] for data in applied }
+                journaled = { owner_name : entry for owner_name, entry in journaled.items() if owner_name not in changed }
+        known = {}
+        fromJournal = 0
+        total = 0
+
+        def pending():
+            nonlocal fromJournal, total
+            for chunk in self._chunks(fullNames, self.graphqlBatch):
+                total += len(chunk)
+                for owner_name in chunk:
+                    entry = journaled.get(owner_name)
+                    if entry and (entry['data']['collaborators'] or not collaborators) and (entry['data']['teams'] or not teams):
+                        state = entry['data']['state']
+                        known[owner_name] = { 'collaborators': state['collaborators'],
+                                              'teams': { slug : tuple(team) for slug, team in state['teams'].items() } }
+                fromJournal = len(known)
+                if self.auditBackend == 'inventory' and self.inventory:
+                    # Trust the stored state of repos audited before; only audit the rest live.
+                    known.update(self.inventory.states(self.org, [ owner_name for owner_name in chunk if owner_name not in known ]))
+                yield from (owner_name for owner_name in chunk if owner_name not in known)
+
+        if self.auditBackend == 'graphql':
+            states = self._auditReposGraphQL(s, pending(), collaborators, teams)
+        else:
+            states = self._auditReposREST(s, pending(), collaborators, teams)
+        if fromJournal:
+            self.logger.info("Journal: resumed with %s of %s repositories already audited", fromJournal, total)
+        if self.auditBackend == 'inventory' and self.inventory:
+            self.logger.info("Inventory: used stored permissions for %s of %s repositories", len(known) - fromJournal, total)
+        if states is None:
+            return None
+        states = self._dropGone(states)
+        # Keep whatever was audited successfully, even if other repos failed.
+        audited = { owner_name : state for owner_name, state in states.items() if state is not None }
+        if self.inventory:
+            self.inventory.saveStates(self.org, audited, collaborators, teams)
+        if op:
+            for owner_name, state in audited.items():
+                self.journal.record(op, owner_name, 'audit', data={ 'collaborators': collaborators, 'teams': teams, 'state': state })
+        if len(audited) < len(states):
+            return None
+        return { **known, **states }
+
+    def _dropGone(self, states):
+        """ Remove repos deleted since they were listed (e.g. by hand, while still in the inventory) from audited {states},
+        and from the inventory. """
+
+        gone = [ owner_name for owner_name, state in states.items() if state is self._gone ]
+        if gone:
+            self.logger.warning("Skipping %s repositories that no longer exist: %s", len(gone), ', '.join(sorted(gone)))
+            if self.inventory:
+                self.inventory.removeRepos(self.org, [ owner_name.split('/', 1)[1] for owner_name in gone ])
+        return { owner_name : state for owner_name, state in states.items() if state is not self._gone }
+
+    def _auditReposREST(self, s, fullNames, collaborators=True, teams=True):
+        """ REST version of _auditRepos(): up to two requests per repo, run concurrently.
+        A repo that could not be audited maps to None. """
+
+        states = {}
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            futures = { pool.submit(self._auditRepo, s, owner_name, collaborators, teams) : owner_name for owner_name in fullNames }
+            repoCount = len(futures)
+            for rCount, future in enumerate(as_completed(futures), 1):
+                if sys.stdout.isatty(): print(f"{rCount:04}/{repoCount}", end=' - audit              \r')
+                try:
+                    states[futures[future]] = future.result()
+                except requests.RequestException as e:
+                    self.logger.error("%s audit failed: %s", futures[future], e)
+                    states[futures[future]] = None
+        return states
+
+    @staticmethod
+    def _chunks(items, size):
+        """ Lists of up to {size} consecutive elements of the iterable {items}. """
+        chunk = []
+        for item in items:
+            chunk.append(item)
+            if len(chunk) == size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def _auditRepo(self, s, owner_name, collaborators=True, teams=True):
+        """ Fetch the direct collaborators and teams of a single repo. Returns None (after logging) on error,
+        or _gone if the repo doesn't exist (any more). """
+
+        state = { 'collaborators': {}, 'teams': {} }
+        if collaborators:
+            # Grab the list of direct collaborators
+            # https://docs.github.com/en/enterprise-server@2.21/rest/reference/repos#list-repository-collaborators
+            u_collab = f"{self.apiURL}/repos/{owner_name}/collaborators"
+            r = s.get(f"{u_collab}?affiliation=direct")
+            if r.status_code == 404:
+                return self._gone
+            if r.status_code != 200:
+                self.logger.error("%s?affiliation=direct status_code %s", u_collab, r.status_code)
+                return None
+            for item in r.json():
+                state['collaborators'][item['login']] = self._permName(item['permissions'])
+
+        if teams:
+            # Grab the list of teams (including staff + admin) and their permission on the repo.
+            # https://docs.github.com/en/enterprise-server@2.21/rest/reference/repos#list-repository-teams
+            t_collab = f"{self.apiURL}/repos/{owner_name}/teams"
+            r = s.get(t_collab)
+            if r.status_code == 404:
+                return self._gone
+            if r.status_code != 200:
+                self.logger.error("%s status_code %s", t_collab, r.status_code)
+                return None
+            for item in r.json():
+                state['teams'][item['slug']] = (item['permission'], item['repositories_url'])
+        return state
+
+    def _teamRepoPerms(self, s, team_repos):
+        """ Page through every repo a team has access to ({team_repos} is its repositories_url), 100 at a time.
+        Returns { full_name : perm }, or None (after logging) on error. """
+
+        # https://docs.github.com/en/enterprise-server@2.21/rest/reference/teams#list-team-repositories
+        perms = {}
+        for page in self._paginate(s, team_repos, phase='audit'):
+            if page is None:
+                return None
+            for item in page:
+                perms[item['full_name']] = self._permName(item['permissions'])
+        return perms
+
+    def _graphql(self, s, query, variables=None, notFoundOK=False):
+        """ Run a GraphQL query against the GHE GraphQL API. Returns the 'data' dict, or None (after logging) on error.
+        With {notFoundOK}, NOT_FOUND errors aren't errors: the objects that weren't found are null in the data. """
+
+        # https://docs.github.com/en/enterprise-server@2.21/graphql/guides/forming-calls-with-graphql
+        r = s.post(self.graphqlURL, json={ 'query': query, 'variables': variables or {} })
+        if r.status_code != 200:
+            self.logger.error("%s status_code %s", self.graphqlURL, r.status_code)
+            return None
+        result = r.json()
+        errors = [ error for error in result.get('errors') or [] if not (notFoundOK and error.get('type') == 'NOT_FOUND') ]
+        if errors or result.get('data') is None:
+            self.logger.error("%s errors: %s", self.graphqlURL, errors or result.get('errors'))
+            return None
+        return result['data']
+
+    # GraphQL RepositoryPermission values, as REST permission names.
+    _graphqlPerms = { 'ADMIN': 'admin', 'MAINTAIN': 'maintain', 'WRITE': 'push', 'TRIAGE': 'triage', 'READ': 'pull' }
+
+    def _auditReposGraphQL(self, s, fullNames, collaborators=True, teams=True):
+        """ GraphQL version of _auditRepos(): collaborators are fetched for up to {graphqlBatch} repos per query,
+        and team permissions by paging through each org team's repositories, so the audit costs roughly
+        N/100 queries instead of 2N REST requests. Same return value as _auditRepos(). """
+
+        states = {}
+        ok = True
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            futures = []
+            # Team repositories don't depend on {fullNames}, so they are fetched while the names are still coming in.
+            if teams:
+                orgTeams = self._graphqlTeams(s)
+                if orgTeams is None:
+                    return None
+                futures += [ pool.submit(self._graphqlTeamRepos, s, slug, team_id) for slug, team_id in orgTeams ]
+
+            for batch in self._chunks(fullNames, self.graphqlBatch):
+                states.update((owner_name, { 'collaborators': {}, 'teams': {} }) for owner_name in batch)
+                if collaborators:
+                    futures.append(pool.submit(self._graphqlCollaborators, s, batch))
+
+            repoCount = len(futures)
+            for rCount, future in enumerate(as_completed(futures), 1):
+                if sys.stdout.isatty(): print(f"{rCount:04}/{repoCount}", end=' - graphql audit              \r')
+                result = future.result()
+                if result is None:
+                    ok = False
+                    continue
+                kind, found = result
+                for owner_name, value in found.items():
+                    if value is self._gone:
+                        states[owner_name] = self._gone
+                    elif owner_name in states and states[owner_name] is not self._gone:
+                        states[owner_name][kind].update(value)
+        return states if ok else None
+
+    def _graphqlCollaborators(self, s, batch):
+        """ Fetch direct collaborators for a batch of repos in one query, using an alias per repo.
+        A repo that doesn't exist (any more) maps to _gone. """
+
+        fields = []
+        for i, owner_name in enumerate(batch):
+            owner, name = owner_name.split('/', 1)
+            fields.append(f"r{i}: repository(owner: {json.dumps(owner)}, name: {json.dumps(name)}) {{ nameWithOwner "
+                          "collaborators(affiliation: DIRECT, first: 100) { totalCount edges { permission node { login } } } }")
+        data = self._graphql(s, "query { " + "\n".join(fields) + " }", notFoundOK=True)
+        if data is None:
+            return None
+
+        found = {}
+        for i, owner_name in enumerate(batch):
+            repo = data.get(f"r{i}")
+            if repo is None:
+                found[owner_name] = self._gone
+                continue
+            if repo['collaborators']['totalCount'] > len(repo['collaborators']['edges']):
+                # Rare: more direct collaborators than fit on one page. Fall back to REST for this repo.
+                state = self._auditRepo(s, owner_name, collaborators=True, teams=False)
+                if state is None:
+                    return None
+                found[owner_name] = state if state is self._gone else state['collaborators']
+                continue
+            found[owner_name] = { edge['node']['login'] : self._graphqlPerms[edge['permission']]
+                                  for edge in repo['collaborators']['edges'] }
+        return 'collaborators', found
+
+    def _graphqlTeams(self, s):
+        """ List the org's teams as (slug, databaseId) pairs. """
+
+        query = """query($org: String!, $after: String) { organization(login: $org) {
+            teams(first: 100, after: $after) { pageInfo { hasNextPage endCursor } nodes { slug databaseId } } } }"""
+        teams = []
+        after = None
+        while True:
+            data = self._graphql(s, query, { 'org': self.org, 'after': after })
+            if data is None:
+                return None
+            page = data['organization']['teams']
+            teams += [ (node['slug'], node['databaseId']) for node in page['nodes'] ]
+            if not page['pageInfo']['hasNextPage']:
+                return teams
+            after = page['pageInfo']['endCursor']
+
+    def _graphqlTeamRepos(self, s, slug, team_id):
+        """ Page through every repo team {slug} has access to. Returns ('teams', { full_name : { slug : (perm, repositories_url) } }). """
+
+        query = """query($org: String!, $slug: String!, $after: String) { organization(login: $org) { team(slug: $slug) {
+            repositories(first: 100, after: $after) { pageInfo { hasNextPage endCursor } edges { permission node { nameWithOwner } } } } } }"""
+        # Same url the REST API reports as the team's repositories_url.
+        team_repos = f"{self.apiURL}/teams/{team_id}/repos"
+        found = {}
+        after = None
+        while True:
+            data = self._graphql(s, query, { 'org': self.org, 'slug': slug, 'after': after })
+            if data is None:
+                return None
+            page = data['organization']['team']['repositories']
+            for edge in page['edges']:
+                found[edge['node']['nameWithOwner']] = { slug : (self._graphqlPerms[edge['permission']], team_repos) }
+            if not page['pageInfo']['hasNextPage']:
+                return 'teams', found
+            after = page['pageInfo']['endCursor']
+
+    def _planPerms(self, states, teamRepos, teamPerms, userPerms=None, staffPerms=None, adminPerms=None):
+        """ Diff audited repo {states}, and the staff/admin {teamPerms} ({ team : { full_name : perm } }), against the
+        desired perms. Returns a list of changes, each a JSON-serializable dict: { repo, kind, target, was, permission, url }. """
+
+        changes = []
+        for owner_name in sorted(states):
+            state = states[owner_name]
             if userPerms:
-                # Do all the direct collaborators (students) first, and then the staff team.
-                self.logger.info("Inspecting direct collaborator permissions.")
-                for rCount, v in enumerate(repos.values(), 1):
-                    if sys.stdout.isatty(): print(f"{rCount:04}/{repoCount}", end=' - direct collaborators              \r')
-                    owner_name = v['full_name']
-                    # Grab the list of direct collaborators
-                    # https://docs.github.com/en/enterprise-server@2.21/rest/reference/repos#list-repository-collaborators
-                    u_collab = f"{self.apiURL}/repos/{owner_name}/collaborators"
-                    r = s.get(f"{u_collab}?affiliation=direct")
-                    if r.status_code == 200:
-                        for item in r.json():
-                            if item['permissions'] != userPermsD:
-                                self.logger.info("Permissions: %s@%s set to %s. Was %s",
-                                                item['login'], owner_name, userPerms, item['permissions'])
-                                if self.doUpdates:
-                                    fix = s.put(f"{u_collab}/{item['login']}", json=userPermsPayload)
-                                    if fix.status_code != 204:
-                                        self.logger.error("GHE API set user perms status code %s", fix.status_code)
-                                        return None
-                    else:
-                        self.logger.error("%s?affiliation=direct status_code %s", u_collab, r.status_code)
-                        return None
+                for login, perm in sorted(state['collaborators'].items()):
+                    if perm != userPerms:
+                        changes.append({ 'repo': owner_name, 'kind': 'user', 'target': login, 'was': perm, 'permission': userPerms,
+                                         'url': f"{self.apiURL}/repos/{owner_name}/collaborators/{login}" })
+                # Teams other than staff + admin are treated as users.
+                for slug, (perm, team_repos) in sorted(state['teams'].items()):
+                    if slug not in ('staff', 'admin') and perm != userPerms:
+                        changes.append({ 'repo': owner_name, 'kind': 'team', 'target': slug, 'was': perm, 'permission': userPerms,
+                                         'url': f"{team_repos}/{owner_name}" })
+            for team, perms in (('staff', staffPerms), ('admin', adminPerms)):
+                if perms:
+                    perm = teamPerms[team].get(owner_name)
+                    if perm != perms:
+                        changes.append({ 'repo': owner_name, 'kind': team, 'target': team, 'was': perm, 'permission': perms,
+                                         'url': f"{teamRepos[team]}/{owner_name}" })
 
-                # Go through teams, update all (as user) except staff + admin.
-                self.logger.info("Inspecting user team permissions.")
-                for rCount, v in enumerate(repos.values(), 1):
-                    if sys.stdout.isatty(): print(f"{rCount:04}/{repoCount}", end=' - user teams              \r')
-                    owner_name = v['full_name']
-                    # Grab the list of direct collaborators
-                    # https://docs.github.com/en/enterprise-server@2.21/rest/reference/repos#list-repository-collaborators
-                    t_collab = f"{self.apiURL}/repos/{owner_name}/teams"
-                    r = s.get(t_collab)
-                    if r.status_code == 200:
-                        for item in r.json():
-                            if item['name'] in ['staff', 'admin']:
-                                continue
-                            if item['permission'] != userPerms:
-                                self.logger.info("Permissions: (team) %s@%s set to %s. Was %s",
-                                                item['name'], owner_name, userPerms, item['permission'])
-                                team_repos = item['repositories_url']
-                                if self.doUpdates:
-                                    fix = s.put(f"{team_repos}/{owner_name}", json=userPermsPayload)
-                                    if fix.status_code != 204:
-                                        self.logger.error("GHE API set user team perms status code %s", fix.status_code)
-                                        return None
-                    else:
-                        self.logger.error("%s status_code %s", t_collab, r.status_code)
-                        return None
+        for change in changes:
+            if change['kind'] == 'user':
+                self.logger.info("Permissions: %s@%s set to %s. Was %s", change['target'], change['repo'], change['permission'], change['was'])
+            else:
+                self.logger.info("Permissions: %s(team)@%s set to %s. Was %s", change['target'], change['repo'], change['permission'], change['was'])
+        return changes
 
-            if staffPerms:
-                self.logger.info("Inspecting staff team permissions.")
-                for rCount, v in enumerate(repos.values(), 1):
-                    if sys.stdout.isatty(): print(f"{rCount:04}/{repoCount}", end=' - staff team              \r')
-                    owner_name = v['full_name']
-                    # Look up the staff team permissions on the repo.
-                    # https://docs.github.com/en/enterprise-server@2.21/rest/reference/teams#check-team-permissions-for-a-repository
-                    u_teams = f"{staff_team_repos}/{owner_name}"
-                    r = s.get(u_teams, headers={'Accept': 'application/vnd.github.v3.repository+json'})
-                    if r.status_code == 200:
-                        existingStaffPermsD = r.json()['permissions']
-                    elif r.status_code == 404:
-                        existingStaffPermsD = None
-                    else:
-                        self.logger.error(f"%s returned %s", u_teams, r.status_code)
-                        return None
-                    if existingStaffPermsD != staffPermsD:
-                        self.logger.info("Permissions: staff(team)@%s set to %s. Was %s", owner_name, staffPerms, existingStaffPermsD)
-                        if self.doUpdates:
-                            fix = s.put(u_teams, json=staffPermsPayload)
-                            if fix.status_code != 204:
-                                self.logger.error("GHE API set staff perms status code %s", fix.status_code)
-                                return None
-
-            if adminPerms:
-                self.logger.info("Inspecting admin team permissions.")
-                for rCount, v in enumerate(repos.values(), 1):
-                    if sys.stdout.isatty(): print(f"{rCount:04}/{repoCount}", end=' - admin team              \r')
-                    owner_name = v['full_name']
-                    # Look up the admin team permissions on the repo.
-                    # https://docs.github.com/en/enterprise-server@2.21/rest/reference/teams#check-team-permissions-for-a-repository
-                    u_teams = f"{admin_team_repos}/{owner_name}"
-                    r = s.get(u_teams, headers={'Accept': 'application/vnd.github.v3.repository+json'})
-                    if r.status_code == 200:
-                        existingAdminPermsD = r.json()['permissions']
-                    elif r.status_code == 404:
-                        existingAdminPermsD = None
-                    else:
-                        self.logger.error(f"%s returned %s", u_teams, r.status_code)
-                        return None
-                    if existingAdminPermsD != adminPermsD:
-                        self.logger.info("Permissions: admin(team)@%s set to %s. Was %s", owner_name, adminPerms, existingAdminPermsD)
-                        if self.doUpdates:
-                            fix = s.put(u_teams, json=adminPermsPayload)
-                            if fix.status_code != 204:
-                                self.logger.error("GHE API set admin perms status code %s", fix.status_code)
-                                return None
+    def _applyChanges(self, s, changes, op=None):
+        """ Apply a list of planned permission changes concurrently: a PUT of the new permission, or the change's
+        'method' (DELETE to revoke, PATCH of a pending invitation) with its 'payload'. A failed change is logged and skipped; the others are recorded in the inventory.
+        Changes already applied under journal operation {op} are skipped. Returns the list of changes that failed. """
 
-        self.logger.info("setAssnPerms complete")
+        s.metrics.phase = 'apply'
+        if op:
+            done = self.journal.doneKeys(op, 'apply')
+            changes = [ change for change in changes if f"{change['url']}={change['permission']}" not in done ]
+        failed = []
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            futures = { pool.submit(s.request, change.get('method', 'PUT'), change['url'],
+                                    json=change.get('payload', { 'permission': change['permission'] } if change['permission'] else None)) : change
+                        for change in changes }
+            for future in as_completed(futures):
+                change = futures[future]
+                try:
+                    r = future.result()
+                    # 201 means an invitation was sent, 204 that the permission was simply set (200: an invitation was updated).
+                    ok = r.status_code in (200, 201, 204)
+                    if not ok:
+                        self.logger.error("GHE API set %s perms %s@%s status code %s", change['kind'], change['target'], change['repo'], r.status_code)
+                except requests.RequestException as e:
+                    # Still failing once the session has run out of retries.
+                    self.logger.error("GHE API set %s perms %s@%s failed: %s", change['kind'], change['target'], change['repo'], e)
+                    ok = False
+                if not ok:
+                    failed.append(change)
+                elif self.inventory:
+                    self.inventory.saveChanges(self.org, [change])
+                if op:
+                    self.journal.record(op, f"{change['url']}={change['permission']}", 'apply', ok=ok, data={ 'repo': change['repo'] })
+        self.logger.info("Applied %s permission changes, %s failed", len(changes) - len(failed), len(failed))
+        return failed
 
     def deleteAssnRepos(self, assn):
         """ Delete all repos that belong to {assn}.
         This function is really only provided to clean up if a mistake was made on initial repo creation.
         It should never be used as a matter of course...
-        REQUIRES personal access token with delete_repo scope."""
+        REQUIRES personal access token with delete_repo scope.
+        Repos are deleted concurrently; failures are logged and the rest carry on. Returns repo name -> True/False."""
 
         if not self.doUpdates:
             self.logger.warning("DRY RUN - NO CHANGES WILL BE MADE")
@@ -401,45 +1964,98 @@ class manageGHE:
 
         with self._getSession() as s:
             # Lookup all current repos
-            myURL = f"{self.apiURL}/orgs/{self.org}/repos"
-            repos = {}
-            while True:
-                r = s.get(myURL)
-                if r.status_code == 200:
-                    for item in r.json():
-                        if item['name'].startswith(f"{assn}_"):
-                            repos[item['name']] = item['url']
-
-                    # https://docs.github.com/en/enterprise-server@2.21/rest/guides/traversing-with-pagination
-                    if 'Link' in r.headers:
-                        links = { x.split(';')[1].strip() : x.split(';')[0].strip(' <>') for x in r.headers['Link'].split(',') }
-                    else:
-                        links = {}
-                    if 'rel="next"' in links:
-                        myURL = links['rel="next"']
-                    else:
-                        break
-                else:
-                    self.logger.error("%s status_code %s", myURL, r.status_code)
-                    return None
+            allItems = self._listOrgRepos(s)
+            if allItems is None:
+                return None
+            repos = { name : item.url for name, item in self._bucketRepos(allItems, [assn])[assn].items() }
+
+            # https://docs.github.com/en/enterprise-server@2.21/rest/reference/repos#delete-a-repository
+            op = f"delete:{self.org}:{assn}" if self.journal and self.doUpdates else None
+            results = self._bulkRepoAction(s, repos, 'DELETE', None, 'deleting', op)
+            if self.inventory and self.doUpdates:
+                self.inventory.removeRepos(self.org, [ repo for repo, ok in results.items() if ok ])
+            return results
+
+    def archiveAssnRepos(self, assn, assnRE=None, archived=True):
+        """ Archive (freeze, read-only) all repos of assignment {assn}, e.g. at its deadline; archived=False unarchives.
+        Repos are archived concurrently and already-archived repos are skipped. Returns repo name -> True/False. """
+
+        if not self.doUpdates:
+            self.logger.warning("DRY RUN - NO CHANGES WILL BE MADE")
+
+        with self._getSession() as s:
+            allItems = self._listOrgRepos(s)
+            if allItems is None:
+                return None
+            matched = self._bucketRepos(allItems, { assn: assnRE })[assn]
+            repos = { name : item.url for name, item in matched.items() if item.archived != archived }
+            self.logger.info("Found %s repositories for %s, %s to %s", len(matched), assn, len(repos), 'archive' if archived else 'unarchive')
+
+            # https://docs.github.com/en/enterprise-server@2.21/rest/reference/repos#update-a-repository
+            op = f"archive:{self.org}:{assn}:{archived}" if self.journal and self.doUpdates else None
+            results = self._bulkRepoAction(s, repos, 'PATCH', { 'archived': archived }, 'archiving' if archived else 'unarchiving', op)
+            if self.inventory and self.doUpdates:
+                self.inventory.setArchived(self.org, [ repo for repo, ok in results.items() if ok ], archived)
+            return results
+
+    def _bulkRepoAction(self, s, repos, method, payload, verb, op=None):
+        """ Send {method} (with JSON {payload}) to every repo url in {repos} (repo name -> url) concurrently.
+        The request is treated as idempotent, so transient failures are retried by the session. A repo that fails
+        is logged and the rest carry on; repos already done under journal operation {op} are skipped.
+        Returns repo name -> True/False. """
+
+        s.metrics.phase = 'apply'
+        if op:
+            repos = { repo : url for repo, url in repos.items() if not self.journal.done(op, repo, method) }
+        for repo in sorted(repos):
+            self.logger.info("%s repo: %s", verb, repo)
+        if not self.doUpdates:
+            return { repo : True for repo in repos }
 
-            for repo,repoURL in repos.items():
-                self.logger.info("deleting repo: %s", repo)
-                # https://docs.github.com/en/enterprise-server@2.21/rest/reference/repos#delete-a-repository
-                if self.doUpdates:
-                    r = s.delete(repoURL)
-                    if r.status_code == 204:
-                        self.logger.debug("deleted repo %s", repoURL)
+        results = {}
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            futures = { pool.submit(s.request, method, url, json=payload, idempotent=True) : (repo, url) for repo, url in repos.items() }
+            for rCount, future in enumerate(as_completed(futures), 1):
+                if sys.stdout.isatty(): print(f"{rCount:04}/{len(repos)}", end=f' - {verb}              \r')
+                repo, url = futures[future]
+                try:
+                    r = future.result()
+                except requests.RequestException as e:
+                    # Still failing once the session has run out of retries.
+                    self.logger.critical("%s %s", url, e)
+                    ok = False
+                else:
+                    # A repo that is already gone counts as deleted.
+                    ok = r.status_code in (200, 204) or (method == 'DELETE' and r.status_code == 404)
+                    if ok:
+                        self.logger.debug("%s %s done", method, url)
                     else:
-                        self.logger.critical("%s status_code %s", repoURL, r.status_code)
-                        return None
+                        self.logger.critical("%s status_code %s", url, r.status_code)
+                results[repo] = ok
+                if op:
+                    self.journal.record(op, repo, method, ok=ok)
+
+        failed = sorted(repo for repo, ok in results.items() if not ok)
+        if op and not failed:
+            self.journal.complete(op)
+        self.logger.info("%s complete: %s done, %s failed", verb, len(results) - len(failed), len(failed))
+        if failed:
+            self.logger.error("Failed: %s", ', '.join(failed))
+        return results
+
+    def clearCache(self):
+        """ Empty the on-disk HTTP cache. """
+        if self.cacheDir and os.path.isdir(self.cacheDir):
+            gheSession(cacheDir=self.cacheDir).clearCache()
+            self.logger.info("Cleared cache %s", self.cacheDir)
 
     def __repr__(self):
         auth = self.github_headers['Authorization'] if 'Authorization' in self.github_headers else None
         retVal = f"""\
         API URL: {self.apiURL}
   Authorization: {auth}
-            Org: {self.org}"""
+            Org: {self.org}
+          Cache: {self.cacheDir}"""
         if not self.doUpdates:
             retVal += "\n *** DRY RUN - NO CHANGES WILL BE MADE ***"
         return retVal
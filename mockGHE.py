@@ -0,0 +1,470 @@
+#!/usr/bin/python3
+# A local stand-in for the parts of the GitHub Enterprise REST API that manageGHE uses, for benchmarking
+# and regression testing without touching github.students.cs.ubc.ca. Not a faithful GitHub implementation:
+# just enough of each endpoint (pagination Link headers, ETags, rate-limit headers, injected latency).
+#
+#   python3 mockGHE.py --repos 5000 --port 8000
+#   export GHE_APIURL=http://127.0.0.1:8000/api/v3 GHE_ORG=MOCK-ORG GHE_TOKEN=anything
+
+import re
+import sys
+import json
+import time
+import random
+import hashlib
+import argparse
+import threading
+from urllib.parse import urlsplit, parse_qs, urlencode
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+class mockOrg:
+    """ In-memory state of one org: repos with their direct collaborators and team permissions, teams, and the
+    org's recent events. """
+
+    maxEvents = 300
+
+    def __init__(self, name):
+        self.name = name
+        self.repos = {}
+        self.teams = {}
+        self.users = set()
+        self.events = []
+        self._nextId = 1
+        self.lock = threading.RLock()
+
+    def newId(self):
+        with self.lock:
+            self._nextId += 1
+            return self._nextId
+
+    def addTeam(self, slug, members=()):
+        self.teams[slug] = { 'id': self.newId(), 'slug': slug, 'name': slug, 'members': list(members) }
+        self.users.update(members)
+        return self.teams[slug]
+
+    def addEvent(self, kind, repo, actor='mock-admin', payload=None, public=False):
+        """ Record an org event (newest last; only the latest {maxEvents} are kept, as on GitHub). Call this after
+        changing a repo directly, to simulate a change someone made by hand. Events of private repos (all the
+        mock's repos) are not {public}, so they only show up in the authenticated user's view of the org's events. """
+        with self.lock:
+            self.events.append({ 'id': str(self.newId()), 'type': kind, 'actor': { 'login': actor }, 'public': public,
+                                 'repo': { 'name': f"{self.name}/{repo}" }, 'payload': payload or {},
+                                 'created_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()) })
+            del self.events[:-self.maxEvents]
+
+    def addRepo(self, name, is_template=False, branches=('main',), readyAt=0):
+        """ Add a repo. Its {branches} only show up from time {readyAt} on, like a repo still being generated. """
+        now = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+        self.repos[name] = { 'id': self.newId(), 'name': name, 'collaborators': {}, 'invitations': {}, 'teams': {}, 'is_template': is_template,
+                             'archived': False, 'created_at': now, 'updated_at': now, 'pushed_at': now,
+                             'branches': list(branches), 'ready_at': readyAt }
+        return self.repos[name]
+
+    def addInvitation(self, repo, login, perm='push'):
+        """ Invite {login} to {repo}: a pending invitation, not yet a collaborator. """
+        invitation_id = self.newId()
+        self.repos[repo]['invitations'][invitation_id] = { 'login': login, 'permission': perm }
+        return invitation_id
+
+    @classmethod
+    def synthetic(cls, name='MOCK-ORG', repos=1000, assns=5, seed=0):
+        """ An org with 'students', 'staff' and 'admin' teams and about {repos} assignment repos spread over {assns}
+        assignments, with a sprinkling of wrong permissions for setAssnPerms to find. """
+        rnd = random.Random(seed)
+        org = cls(name)
+        students = [ f"student{i:05}" for i in range(max(1, repos // max(1, assns))) ]
+        org.addTeam('students', students)
+        org.addTeam('staff', [ f"ta{i:02}" for i in range(10) ])
+        org.addTeam('admin', [ 'instructor' ])
+        org.addRepo('assnTemplate', is_template=True)
+        for a in range(1, assns + 1):
+            for student in students:
+                repo = org.addRepo(f"assn{a}_{student}")
+                repo['collaborators'][student] = rnd.choice(('push', 'push', 'push', 'pull'))
+                repo['teams']['staff'] = rnd.choice(('admin', 'admin', 'push'))
+        return org
+
+
+class mockHandler(BaseHTTPRequestHandler):
+    """ Routes requests to the mockGHE server's org. """
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    # --- plumbing
+
+    def _route(self, method):
+        parts = urlsplit(self.path)
+        self.query = { k : v[-1] for k, v in parse_qs(parts.query).items() }
+        length = int(self.headers.get('Content-Length') or 0)
+        self.body = json.loads(self.rfile.read(length)) if length else {}
+        self.server.count(method, parts.path)
+        if self.server.latency:
+            time.sleep(self.server.latency * random.uniform(0.5, 1.5))
+
+        if not self.server.takeQuota():
+            return self._send(403, { 'message': 'API rate limit exceeded' })
+        path = parts.path[len(self.server.prefix):] if parts.path.startswith(self.server.prefix) else None
+        if path and path.startswith('/orgs/') and path.split('/')[2] != self.server.org.name:
+            return self._send(404, { 'message': 'Not Found' })
+        for pattern, name in self.routes:
+            m = re.fullmatch(pattern, f"{method} {path}")
+            if m:
+                with self.server.org.lock:
+                    return getattr(self, name)(*m.groups())
+        self._send(404, { 'message': 'Not Found' })
+
+    def do_GET(self): self._route('GET')
+    def do_POST(self): self._route('POST')
+    def do_PUT(self): self._route('PUT')
+    def do_PATCH(self): self._route('PATCH')
+    def do_DELETE(self): self._route('DELETE')
+
+    def _send(self, status, body=None, headers=None):
+        data = json.dumps(body).encode() if body is not None else b''
+        headers = dict(headers or {})
+        if self.command == 'GET' and status == 200:
+            etag = '"' + hashlib.sha1(data).hexdigest() + '"'
+            headers['ETag'] = etag
+            if self.headers.get('If-None-Match') == etag:
+                # Conditional hits are free, as on GitHub.
+                self.server.refundQuota()
+                status, data = 304, b''
+        self.send_response(status)
+        for k, v in { **self.server.rateHeaders(), **headers }.items():
+            self.send_header(k, v)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _paged(self, items, headers=None):
+        """ Send one page of {items}, with a GitHub-style Link header. """
+        perPage = min(int(self.query.get('per_page', 30)), 100)
+        page = int(self.query.get('page', 1))
+        last = max(1, -(-len(items) // perPage))
+        base = f"http://{self.headers['Host']}{urlsplit(self.path).path}"
+
+        def link(p):
+            return f"{base}?{urlencode({ **self.query, 'page': p })}"
+        links = []
+        if page < last:
+            links += [ f'<{link(page + 1)}>; rel="next"', f'<{link(last)}>; rel="last"' ]
+        if page > 1:
+            links += [ f'<{link(1)}>; rel="first"', f'<{link(page - 1)}>; rel="prev"' ]
+        if links:
+            headers = { **(headers or {}), 'Link': ', '.join(links) }
+        self._send(200, items[(page - 1) * perPage : page * perPage], headers)
+
+    # --- representations
+
+    def _api(self):
+        return f"http://{self.headers['Host']}{self.server.prefix}"
+
+    @staticmethod
+    def _perms(perm):
+        return { 'admin': perm == 'admin', 'maintain': perm in ('admin', 'maintain'), 'push': perm in ('admin', 'maintain', 'push'),
+                 'triage': perm in ('admin', 'maintain', 'push', 'triage'), 'pull': perm is not None }
+
+    def _repo(self, repo, perm=None):
+        org = self.server.org.name
+        item = { 'id': repo['id'], 'name': repo['name'], 'full_name': f"{org}/{repo['name']}", 'private': True,
+                 'owner': { 'login': org, 'type': 'Organization' }, 'url': f"{self._api()}/repos/{org}/{repo['name']}",
+                 'is_template': repo['is_template'], 'archived': repo['archived'], 'default_branch': 'main',
+                 'created_at': repo['created_at'], 'updated_at': repo['updated_at'], 'pushed_at': repo['pushed_at'] }
+        if perm:
+            item['permissions'] = self._perms(perm)
+        return item
+
+    def _team(self, team, perm=None):
+        item = { 'id': team['id'], 'slug': team['slug'], 'name': team['name'],
+                 'url': f"{self._api()}/teams/{team['id']}", 'repositories_url': f"{self._api()}/teams/{team['id']}/repos" }
+        if perm:
+            item['permission'] = perm
+        return item
+
+    def _user(self, login, perm=None):
+        item = { 'login': login, 'type': 'User' }
+        if perm:
+            item['permissions'] = self._perms(perm)
+        return item
+
+    def _findRepo(self, owner, name):
+        if owner != self.server.org.name:
+            return None
+        return self.server.org.repos.get(name)
+
+    def _touch(self, repo):
+        repo['updated_at'] = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+
+    # --- endpoints
+
+    routes = [
+        (r'GET /orgs/([^/]+)/repos', 'listOrgRepos'),
+        (r'POST /orgs/([^/]+)/repos', 'createRepo'),
+        (r'GET /orgs/([^/]+)/events', 'listOrgEvents'),
+        (r'GET /users/([^/]+)/events/orgs/([^/]+)', 'listUserOrgEvents'),
+        (r'GET /user', 'getUser'),
+        (r'GET /orgs/([^/]+)/teams/([^/]+)', 'getTeam'),
+        (r'GET /orgs/([^/]+)/teams/([^/]+)/members', 'listTeamMembers'),
+        (r'GET /teams/(\d+)/repos', 'listTeamRepos'),
+        (r'(GET|PUT|DELETE) /teams/(\d+)/repos/([^/]+)/([^/]+)', 'teamRepo'),
+        (r'GET /repos/([^/]+)/([^/]+)', 'getRepo'),
+        (r'DELETE /repos/([^/]+)/([^/]+)', 'deleteRepo'),
+        (r'PATCH /repos/([^/]+)/([^/]+)', 'updateRepo'),
+        (r'POST /repos/([^/]+)/([^/]+)/generate', 'generateRepo'),
+        (r'GET /repos/([^/]+)/([^/]+)/collaborators', 'listCollaborators'),
+        (r'(PUT|DELETE) /repos/([^/]+)/([^/]+)/collaborators/([^/]+)', 'collaborator'),
+        (r'GET /repos/([^/]+)/([^/]+)/teams', 'listRepoTeams'),
+        (r'GET /repos/([^/]+)/([^/]+)/invitations', 'listInvitations'),
+        (r'(PATCH|DELETE) /repos/([^/]+)/([^/]+)/invitations/(\d+)', 'invitation'),
+        (r'GET /repos/([^/]+)/([^/]+)/branches', 'listBranches'),
+    ]
+
+    def listOrgRepos(self, org):
+        repos = list(self.server.org.repos.values())
+        if self.query.get('sort') == 'updated':
+            repos.sort(key=lambda repo: repo['updated_at'], reverse=self.query.get('direction', 'desc') == 'desc')
+        self._paged([ self._repo(repo) for repo in repos ])
+
+    def listOrgEvents(self, org):
+        self._paged([ event for event in self.server.org.events[::-1] if event['public'] ], { 'X-Poll-Interval': str(self.server.pollInterval) })
+
+    def listUserOrgEvents(self, login, org):
+        if login != self.server.login or org != self.server.org.name:
+            return self._send(404, { 'message': 'Not Found' })
+        self._paged(self.server.org.events[::-1], { 'X-Poll-Interval': str(self.server.pollInterval) })
+
+    def getUser(self):
+        self._send(200, self._user(self.server.login))
+
+    def createRepo(self, org, source=None):
+        name = self.body.get('name')
+        if name in self.server.org.repos:
+            return self._send(422, { 'message': 'Repository creation failed.' })
+        if source:
+            # Generation from a template finishes in the background.
+            repo = self.server.org.addRepo(name, branches=source['branches'], readyAt=time.time() + self.server.generateDelay)
+        else:
+            repo = self.server.org.addRepo(name, branches=())
+        for team in self.server.org.teams.values():
+            if team['id'] == self.body.get('team_id'):
+                repo['teams'][team['slug']] = 'pull'
+        self.server.org.addEvent('RepositoryEvent', name, payload={ 'action': 'created' })
+        self._send(201, self._repo(repo))
+
+    def generateRepo(self, owner, template):
+        source = self._findRepo(owner, template)
+        if source is None or not source['is_template']:
+            return self._send(404, { 'message': 'Not Found' })
+        return self.createRepo(owner, source)
+
+    def listBranches(self, owner, name):
+        repo = self._findRepo(owner, name)
+        if repo is None:
+            return self._send(404, { 'message': 'Not Found' })
+        branches = repo['branches'] if time.time() >= repo['ready_at'] else []
+        self._paged([ { 'name': branch, 'protected': False } for branch in branches ])
+
+    def getTeam(self, org, slug):
+        team = self.server.org.teams.get(slug)
+        if team is None:
+            return self._send(404, { 'message': 'Not Found' })
+        self._send(200, self._team(team))
+
+    def listTeamMembers(self, org, slug):
+        team = self.server.org.teams.get(slug)
+        if team is None:
+            return self._send(404, { 'message': 'Not Found' })
+        self._paged([ self._user(login) for login in team['members'] ])
+
+    def _teamById(self, team_id):
+        return next((team for team in self.server.org.teams.values() if team['id'] == int(team_id)), None)
+
+    def listTeamRepos(self, team_id):
+        team = self._teamById(team_id)
+        if team is None:
+            return self._send(404, { 'message': 'Not Found' })
+        self._paged([ self._repo(repo, repo['teams'][team['slug']]) for repo in self.server.org.repos.values() if team['slug'] in repo['teams'] ])
+
+    def teamRepo(self, method, team_id, owner, name):
+        team = self._teamById(team_id)
+        repo = self._findRepo(owner, name)
+        if team is None or repo is None:
+            return self._send(404, { 'message': 'Not Found' })
+        if method == 'GET':
+            if team['slug'] not in repo['teams']:
+                return self._send(404, { 'message': 'Not Found' })
+            return self._send(200, self._repo(repo, repo['teams'][team['slug']]))
+        if method == 'PUT':
+            repo['teams'][team['slug']] = self.body.get('permission', 'push')
+            self.server.org.addEvent('TeamAddEvent', name, payload={ 'team': self._team(team) })
+        else:
+            repo['teams'].pop(team['slug'], None)
+        self._send(204)
+
+    def getRepo(self, owner, name):
+        repo = self._findRepo(owner, name)
+        if repo is None:
+            return self._send(404, { 'message': 'Not Found' })
+        self._send(200, self._repo(repo))
+
+    def deleteRepo(self, owner, name):
+        if self._findRepo(owner, name) is None:
+            return self._send(404, { 'message': 'Not Found' })
+        del self.server.org.repos[name]
+        self._send(204)
+
+    def updateRepo(self, owner, name):
+        repo = self._findRepo(owner, name)
+        if repo is None:
+            return self._send(404, { 'message': 'Not Found' })
+        if 'archived' in self.body:
+            repo['archived'] = bool(self.body['archived'])
+        self._touch(repo)
+        self._send(200, self._repo(repo))
+
+    def listCollaborators(self, owner, name):
+        repo = self._findRepo(owner, name)
+        if repo is None:
+            return self._send(404, { 'message': 'Not Found' })
+        self._paged([ self._user(login, perm) for login, perm in repo['collaborators'].items() ])
+
+    def collaborator(self, method, owner, name, login):
+        repo = self._findRepo(owner, name)
+        if repo is None:
+            return self._send(404, { 'message': 'Not Found' })
+        if method == 'DELETE':
+            repo['collaborators'].pop(login, None)
+            return self._send(204)
+        invited = login not in repo['collaborators']
+        repo['collaborators'][login] = self.body.get('permission', 'push')
+        if invited:
+            # As on GitHub, changing an existing collaborator's permission produces no event.
+            self.server.org.addEvent('MemberEvent', name, payload={ 'action': 'added', 'member': self._user(login) })
+        self._send(201 if invited else 204, { 'id': self.server.org.newId() } if invited else None)
+
+    # Invitation permission names, by REST permission name.
+    _invitationNames = { 'pull': 'read', 'triage': 'triage', 'push': 'write', 'maintain': 'maintain', 'admin': 'admin' }
+
+    def _invitation(self, repo, invitation_id, invitation):
+        return { 'id': invitation_id, 'repository': self._repo(repo), 'invitee': self._user(invitation['login']),
+                 'permissions': self._invitationNames[invitation['permission']] }
+
+    def listInvitations(self, owner, name):
+        repo = self._findRepo(owner, name)
+        if repo is None:
+            return self._send(404, { 'message': 'Not Found' })
+        self._paged([ self._invitation(repo, invitation_id, invitation) for invitation_id, invitation in repo['invitations'].items() ])
+
+    def invitation(self, method, owner, name, invitation_id):
+        repo = self._findRepo(owner, name)
+        if repo is None or int(invitation_id) not in repo['invitations']:
+            return self._send(404, { 'message': 'Not Found' })
+        if method == 'DELETE':
+            del repo['invitations'][int(invitation_id)]
+            return self._send(204)
+        names = { name : perm for perm, name in self._invitationNames.items() }
+        invitation = repo['invitations'][int(invitation_id)]
+        invitation['permission'] = names.get(self.body.get('permissions'), invitation['permission'])
+        self._send(200, self._invitation(repo, int(invitation_id), invitation))
+
+    def listRepoTeams(self, owner, name):
+        repo = self._findRepo(owner, name)
+        if repo is None:
+            return self._send(404, { 'message': 'Not Found' })
+        self._paged([ self._team(self.server.org.teams[slug], perm) for slug, perm in repo['teams'].items() ])
+
+
+class mockGHE(ThreadingHTTPServer):
+    """ The stand-in server. Serves {org} under /api/v3 with {latency} seconds (+-50%) added to every request, and a
+    {rateLimit}-request quota per {rateWindow} seconds reported in X-RateLimit-* headers. Request counts by method and
+    endpoint are kept in {counts}; {quotaUsed} counts rate-limit points (conditional 304s are free).
+    Repos generated from a template only get their branches {generateDelay} seconds after the generate call.
+    The org events listing asks clients to poll it no more than every {pollInterval} seconds (X-Poll-Interval). """
+
+    daemon_threads = True
+    prefix = '/api/v3'
+    # Whoever the token belongs to.
+    login = 'mock-admin'
+
+    def __init__(self, org, port=0, latency=0.0, rateLimit=5000, rateWindow=3600, generateDelay=0.0, verbose=False, pollInterval=60):
+        super().__init__(('127.0.0.1', port), mockHandler)
+        self.org = org
+        self.pollInterval = pollInterval
+        self.latency = latency
+        self.generateDelay = generateDelay
+        self.rateLimit = rateLimit
+        self.rateWindow = rateWindow
+        self.verbose = verbose
+        self.counts = {}
+        self.quotaUsed = 0
+        self._lock = threading.Lock()
+        self._resetWindow()
+
+    @property
+    def apiURL(self):
+        return f"http://127.0.0.1:{self.server_address[1]}{self.prefix}"
+
+    def _resetWindow(self):
+        self.remaining = self.rateLimit
+        self.reset = int(time.time()) + self.rateWindow
+
+    def count(self, method, path):
+        # Collapse names and ids so counts are per endpoint.
+        path = re.sub(r'/(repos|orgs|teams|collaborators|members)/[^/]+', r'/\1/*', path)
+        path = re.sub(r'/repos/\*/[^/]+', '/repos/*/*', path)
+        with self._lock:
+            self.counts[f"{method} {path}"] = self.counts.get(f"{method} {path}", 0) + 1
+
+    def takeQuota(self):
+        with self._lock:
+            if time.time() >= self.reset:
+                self._resetWindow()
+            if self.remaining <= 0:
+                return False
+            self.remaining -= 1
+            self.quotaUsed += 1
+            return True
+
+    def refundQuota(self):
+        with self._lock:
+            self.remaining += 1
+            self.quotaUsed -= 1
+
+    def rateHeaders(self):
+        return { 'X-RateLimit-Limit': str(self.rateLimit), 'X-RateLimit-Remaining': str(self.remaining),
+                 'X-RateLimit-Reset': str(self.reset) }
+
+    def requestCount(self):
+        return sum(self.counts.values())
+
+    def start(self):
+        """ Serve from a background thread. """
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve a synthetic org on a local stand-in GHE API.")
+    parser.add_argument('--org', default='MOCK-ORG')
+    parser.add_argument('--repos', type=int, default=1000)
+    parser.add_argument('--assns', type=int, default=5)
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds added to each request")
+    parser.add_argument('--rate-limit', type=int, default=5000)
+    parser.add_argument('--generate-delay', type=float, default=0.0, help="seconds until a generated repo has its branches")
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+
+    server = mockGHE(mockOrg.synthetic(args.org, args.repos, args.assns), args.port, args.latency, args.rate_limit,
+                     generateDelay=args.generate_delay, verbose=args.verbose)
+    print(f"export GHE_APIURL={server.apiURL} GHE_ORG={args.org} GHE_TOKEN=mock", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass